@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+# Бенчмарк my_own_module: run_module() вызывается напрямую с подмененными аргументами
+# AnsibleModule на временной файловой системе. Каждый случай (create / noop / update,
+# check и real mode) выполняется в отдельном процессе, чтобы пиковый RSS и счетчики
+# /proc/self/io относились только к нему.
+#
+# Примеры:
+#   python benchmarks/bench_my_own_module.py
+#   python benchmarks/bench_my_own_module.py --sizes 1K,1G --counts 1
+#   python benchmarks/bench_my_own_module.py --sizes 1K --counts 10,10000 --extra '{"workers": 8}'
+#
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'plugins', 'modules')
+
+CASES = ('create', 'noop', 'update')
+MODES = ('check', 'real')
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value):
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f'{size // UNITS[unit]}{unit}'
+    return str(size)
+
+
+def make_content(size):
+    pattern = '0123456789abcdef line of benchmark content\n'
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def proc_io():
+    # rchar/wchar - байты, прошедшие через read/write, включая page cache
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def run_case(spec):
+    #
+    # Выполняется в дочернем процессе: готовит файлы, вызывает run_module и
+    # возвращает измерения. Время и I/O подготовки в результат не входят
+    #
+    sys.path.insert(0, MODULES_DIR)
+    import my_own_module
+    from ansible.module_utils import basic
+
+    root = tempfile.mkdtemp(prefix='bench-my-own-module-', dir=spec['tmpdir'])
+    try:
+        content = make_content(spec['size'])
+        paths = [os.path.join(root, f'd{n % 100}', f'file{n}.txt') for n in range(spec['count'])]
+        if spec['case'] != 'create':
+            # update: отличается только последний байт - худший случай для сравнения
+            old = content if spec['case'] == 'noop' else content[:-1] + ('#' if content[-1:] != '#' else '$')
+            for path in paths:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(old)
+
+        args = dict(spec['extra'])
+        if spec['count'] == 1:
+            args.update(path=paths[0], content=content)
+        else:
+            args['files'] = [dict(path=path, content=content) for path in paths]
+        args['_ansible_check_mode'] = spec['mode'] == 'check'
+        del content
+
+        try:
+            from ansible.module_utils.testing import patch_module_args
+            patch_args = patch_module_args(args)
+        except ImportError:
+            # ansible-core < 2.19 читает аргументы из basic._ANSIBLE_ARGS
+            basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=args)).encode('utf-8')
+            patch_args = contextlib.nullcontext()
+
+        #
+        # Измерения снимаются в момент вызова exit_json/fail_json: вывод модуля
+        # (с invocation.module_args, то есть со всем content) в них не попадает
+        #
+        measured = {}
+
+        def measure(exit_method):
+            def wrapper(module, **kwargs):
+                measured['wall'] = time.perf_counter() - start
+                measured['io'] = proc_io()
+                measured['rss_peak'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                return exit_method(module, **kwargs)
+            return wrapper
+
+        basic.AnsibleModule.exit_json = measure(basic.AnsibleModule.exit_json)
+        basic.AnsibleModule.fail_json = measure(basic.AnsibleModule.fail_json)
+
+        output = tempfile.TemporaryFile(mode='w+', dir=spec['tmpdir'])
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        read_before, written_before = proc_io()
+        start = time.perf_counter()
+        with patch_args, contextlib.redirect_stdout(output):
+            try:
+                my_own_module.run_module()
+            except SystemExit:
+                pass
+        wall = measured['wall']
+        read_after, written_after = measured['io']
+        rss_peak = measured['rss_peak']
+
+        output.seek(0)
+        result = json.loads(output.read())
+        if result.get('failed'):
+            raise RuntimeError(result.get('msg'))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return dict(
+        wall=wall,
+        # ru_maxrss в KB на Linux
+        rss_peak=rss_peak * 1024,
+        rss_growth=(rss_peak - rss_before) * 1024,
+        read=None if read_before is None else read_after - read_before,
+        written=None if written_before is None else written_after - written_before,
+        changed=result['changed'],
+    )
+
+
+def run_child(spec):
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(spec)],
+        capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f'case {spec} failed with exit code {proc.returncode}:\n{proc.stderr}')
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def mb(value):
+    return '-' if value is None else f'{value / 1024 ** 2:.1f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark my_own_module run_module() on a temporary filesystem.')
+    parser.add_argument('--sizes', default='1K,1M,64M', help='comma separated file sizes, e.g. 1K,1M,1G')
+    parser.add_argument('--counts', default='1,10,1000', help='comma separated numbers of files per run')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma separated cases: create, noop, update')
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated modes: check, real')
+    parser.add_argument('--max-total', default='1G',
+                        help='skip size/count combinations with more content than this per run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case, the fastest one is reported')
+    parser.add_argument('--extra', default='{}', help='extra module arguments as JSON, e.g. {"fsync": "file"}')
+    parser.add_argument('--tmpdir', default=None, help='directory for the test files (default: system temp)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.run_case:
+        print(json.dumps(run_case(json.loads(options.run_case))))
+        return
+
+    extra = json.loads(options.extra)
+    max_total = parse_size(options.max_total)
+    if not options.json:
+        print(f"{'size':>6} {'files':>6} {'mode':>5} {'case':>6} {'wall ms':>10} {'ms/file':>9} "
+              f"{'MB/s':>8} {'peak RSS MB':>11} {'+RSS MB':>8} {'read MB':>9} {'written MB':>10} changed")
+
+    for size in [parse_size(s) for s in options.sizes.split(',')]:
+        for count in [int(c) for c in options.counts.split(',')]:
+            if size * count > max_total:
+                print(f'# skipped {format_size(size)} x {count}: more than --max-total {options.max_total}',
+                      file=sys.stderr)
+                continue
+            for mode in options.modes.split(','):
+                for case in options.cases.split(','):
+                    spec = dict(size=size, count=count, mode=mode, case=case, extra=extra, tmpdir=options.tmpdir)
+                    runs = [run_child(spec) for _ in range(max(1, options.repeat))]
+                    best = min(runs, key=lambda r: r['wall'])
+                    row = dict(size=size, count=count, mode=mode, case=case, **best)
+                    if options.json:
+                        print(json.dumps(row), flush=True)
+                        continue
+                    throughput = size * count / best['wall'] / 1024 ** 2 if best['wall'] else 0
+                    print(f"{format_size(size):>6} {count:>6} {mode:>5} {case:>6} {best['wall'] * 1000:>10.1f} "
+                          f"{best['wall'] * 1000 / count:>9.3f} {throughput:>8.1f} {mb(best['rss_peak']):>11} "
+                          f"{mb(best['rss_growth']):>8} {mb(best['read']):>9} {mb(best['written']):>10} "
+                          f"{best['changed']}", flush=True)
+
+
+if __name__ == '__main__':
+    main()
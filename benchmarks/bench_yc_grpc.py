@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+# Бенчмарк каналов yc на локальном фейковом сервере Compute: параллельный скан каталогов
+# (List + FULL Get каждой VM, как scan_folder в reconcile) через пул instance_service_pool
+# с разным числом каналов и сжатием. Каналы открываются с опциями grpc_channel_options,
+# задержка сервера имитирует RTT до API.
+#
+# grpc_compression сжимает запросы; сжатие ответов выбирает сервер, поэтому в случаях gzip
+# фейковый сервер тоже отвечает gzip. На loopback сжатие видно только как затраты CPU,
+# выигрыш по трафику зависит от канала до API.
+#
+# Примеры:
+#   python benchmarks/bench_yc_grpc.py
+#   python benchmarks/bench_yc_grpc.py --channels 1,2,8 --latency 50 --metadata-size 256K
+#
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'plugins', 'modules')
+sys.path.insert(0, MODULES_DIR)
+
+import grpc  # noqa: E402
+import yc  # noqa: E402
+from yandex.cloud.compute.v1 import instance_service_pb2_grpc  # noqa: E402
+from yandex.cloud.compute.v1.instance_pb2 import Instance  # noqa: E402
+from yandex.cloud.compute.v1.instance_service_pb2 import ListInstancesResponse  # noqa: E402
+
+UNITS = {'K': 1024, 'M': 1024 ** 2}
+
+
+def parse_size(value):
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+class FakeInstanceService(instance_service_pb2_grpc.InstanceServiceServicer):
+    def __init__(self, folders, vms, metadata_size, latency):
+        self.latency = latency
+        # user-data похожа на cloud-init: текст, который хорошо сжимается
+        user_data = ('#cloud-config\npackages: [nginx, curl, jq]\n' * (metadata_size // 40 + 1))[:metadata_size]
+        self.instances = {}
+        self.folders = {}
+        for f in range(folders):
+            folder_id = f'folder{f}'
+            self.folders[folder_id] = []
+            for n in range(vms):
+                instance = Instance(
+                    id=f'{folder_id}-vm{n}', folder_id=folder_id, name=f'vm{n}',
+                    status=Instance.Status.RUNNING, metadata={'user-data': user_data},
+                )
+                self.instances[instance.id] = instance
+                self.folders[folder_id].append(instance)
+
+    def List(self, request, context):
+        time.sleep(self.latency)
+        return ListInstancesResponse(instances=[
+            Instance(id=i.id, folder_id=i.folder_id, name=i.name, status=i.status)
+            for i in self.folders.get(request.folder_id, [])
+        ])
+
+    def Get(self, request, context):
+        time.sleep(self.latency)
+        return self.instances[request.instance_id]
+
+
+class LocalChannels:
+    # То же, что использует instance_service_pool у SDK: channel_options и _create_channel
+    def __init__(self, address, options):
+        self.address = address
+        self.channel_options = tuple(options)
+        self.cached = None
+        self.opened = []
+
+    def _create_channel(self, service):
+        channel = grpc.insecure_channel(self.address, options=self.channel_options)
+        self.opened.append(channel)
+        return channel
+
+    def channel(self, service):
+        if self.cached is None:
+            self.cached = self._create_channel(service)
+        return self.cached
+
+
+class LocalSDK:
+    def __init__(self, address, options):
+        self._channels = LocalChannels(address, options)
+        self._default_interceptor = None
+
+    def client(self, stub):
+        return stub(self._channels.channel('compute'))
+
+
+def run_case(address, folder_ids, channels, compression, workers):
+    params = dict(
+        grpc_keepalive_time=None, grpc_compression=compression, grpc_max_receive_size=64,
+        grpc_call_timeout=None, grpc_channels=channels,
+    )
+    sdk = LocalSDK(address, yc.grpc_channel_options(params))
+    services = yc.instance_service_pool(sdk, channels)
+    # Каталоги по кругу раскладываются по каналам пула, как в reconcile
+    folder_services = {folder_id: services[n % len(services)] for n, folder_id in enumerate(folder_ids)}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(folder_ids)))) as executor:
+        scanned = list(executor.map(
+            lambda folder_id: yc.scan_folder(folder_services[folder_id], folder_id),
+            folder_ids,
+        ))
+    wall = time.perf_counter() - start
+    for channel in sdk._channels.opened:
+        channel.close()
+    return wall, sum(len(instances) for instances in scanned)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark yc folder scans on a local fake Compute API server.')
+    parser.add_argument('--channels', default='1,4', help='comma separated grpc_channels values')
+    parser.add_argument('--compression', default='none,gzip', help='comma separated grpc_compression values')
+    parser.add_argument('--folders', type=int, default=8, help='number of folders scanned in parallel')
+    parser.add_argument('--vms', type=int, default=20, help='VMs per folder')
+    parser.add_argument('--workers', type=int, default=8, help='max_workers: folders scanned at once')
+    parser.add_argument('--metadata-size', default='16K', help='size of the user-data metadata of each VM')
+    parser.add_argument('--latency', type=float, default=5, help='server delay per call in ms')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest one is reported')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    options = parser.parse_args()
+
+    servicer = FakeInstanceService(
+        options.folders, options.vms, parse_size(options.metadata_size), options.latency / 1000,
+    )
+    folder_ids = list(servicer.folders)
+    if not options.json:
+        print(f"{'channels':>8} {'compression':>11} {'VMs':>6} {'wall ms':>10} {'ms/VM':>8}")
+
+    for compression in options.compression.split(','):
+        server = grpc.server(
+            ThreadPoolExecutor(max_workers=64),
+            compression=grpc.Compression.Gzip if compression == 'gzip' else None,
+        )
+        instance_service_pb2_grpc.add_InstanceServiceServicer_to_server(servicer, server)
+        port = server.add_insecure_port('127.0.0.1:0')
+        server.start()
+        try:
+            for channels in [int(c) for c in options.channels.split(',')]:
+                runs = [
+                    run_case(f'127.0.0.1:{port}', folder_ids, channels, compression, options.workers)
+                    for _ in range(max(1, options.repeat))
+                ]
+                wall, count = min(runs)
+                if options.json:
+                    print(json.dumps(dict(channels=channels, compression=compression, vms=count, wall=wall)),
+                          flush=True)
+                    continue
+                print(f"{channels:>8} {compression:>11} {count:>6} {wall * 1000:>10.1f} "
+                      f"{wall * 1000 / count:>8.3f}", flush=True)
+        finally:
+            server.stop(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+# Copyright: (c) 2018, Terry Jones <terry.jones@example.org>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+# For Python 3.12+
+#
+from __future__ import annotations
+__metaclass__ = type
+
+import base64
+import gzip
+import hashlib
+import zlib
+
+from ansible.plugins.action import ActionBase
+
+try:
+    import zstandard
+    HAS_ZSTANDARD = True
+except ImportError:
+    HAS_ZSTANDARD = False
+
+# Модуль adler32: скользящая сумма должна совпадать с zlib.adler32 на удаленном хосте
+ADLER_MOD = 65521
+# На сколько блоков вперед катим окно после несовпавшего блока
+DELTA_SCAN_BLOCKS = 2
+# Предел побайтового поиска в Python на файл - дальше выгоднее отправить content целиком
+DELTA_SCAN_BUDGET = 8 * 1024 * 1024
+# Меньше этого content отправляется сразу: лишний round trip пробы дороже самой передачи
+PROBE_MIN_CONTENT = 64 * 1024
+
+
+def content_size(items):
+    return sum(len(item.get('content') or '') + len(item.get('content_b64') or '') for item in items)
+
+
+def item_plaintext(item):
+    #
+    # Открытый текст файла; для content_b64 - после декодирования и распаковки.
+    # None, если получить его на контроллере нельзя (нет zstandard или payload битый)
+    #
+    if item.get('content_b64') is None:
+        return (item.get('content') or '').encode('utf-8')
+
+    compression = item.get('content_compression') or 'none'
+    if compression == 'zstd' and not HAS_ZSTANDARD:
+        return None
+
+    try:
+        raw = base64.b64decode(''.join(item['content_b64'].split()), validate=True)
+        if compression == 'gzip':
+            return gzip.decompress(raw)
+        if compression == 'zstd':
+            return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True).read()
+        return raw
+    except Exception:
+        # Битый payload - пусть модуль сам вернет понятную ошибку
+        return None
+
+
+def strong_sum(block):
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def compute_delta(data, signatures):
+    #
+    # rsync-подобный поиск: блок на текущей позиции сначала ищется по сильной сумме,
+    # при промахе окно катится побайтово (adler32) до DELTA_SCAN_BLOCKS блоков вперед.
+    # После каждого неудачного поиска следующий откладывается вдвое дальше, так что
+    # на полностью новом содержимом почти вся работа - сильные суммы блоков на C.
+    # Возвращает операции ['copy', k, n] / ['data', b64] или None, если delta невыгодна
+    #
+    block_size = signatures['block_size']
+    old_size = signatures['size']
+
+    strong_index = {}
+    weak_index = set()
+    for k, (weak, strong) in enumerate(signatures['blocks']):
+        length = min(block_size, old_size - k * block_size)
+        strong_index.setdefault((length, strong), k)
+        if length == block_size:
+            weak_index.add(weak)
+
+    ops = []
+    literal_bytes = 0
+    scanned = 0
+    size = len(data)
+    view = memoryview(data)
+    pos = 0
+    literal_start = 0
+    misses = 0
+    next_scan = 0
+
+    def flush_literal(end):
+        nonlocal literal_bytes
+        if end > literal_start:
+            ops.append(['data', base64.b64encode(view[literal_start:end]).decode()])
+            literal_bytes += end - literal_start
+
+    while pos < size:
+        length = min(block_size, size - pos)
+        k = strong_index.get((length, strong_sum(view[pos:pos + length])))
+        if k is not None:
+            flush_literal(pos)
+            if ops and ops[-1][0] == 'copy' and ops[-1][1] + ops[-1][2] == k:
+                ops[-1][2] += 1
+            else:
+                ops.append(['copy', k, 1])
+            pos += length
+            literal_start = pos
+            misses = 0
+            continue
+
+        # Скользящее окно по несовпавшему участку
+        match = None
+        scan_end = min(size - block_size, pos + DELTA_SCAN_BLOCKS * block_size)
+        if pos < next_scan:
+            scan_end = pos
+        if weak_index and scan_end > pos:
+            weak = zlib.adler32(view[pos:pos + block_size])
+            a, b = weak & 0xffff, weak >> 16
+            for i in range(pos, scan_end):
+                out_byte, in_byte = data[i], data[i + block_size]
+                a = (a - out_byte + in_byte) % ADLER_MOD
+                b = (b - block_size * out_byte - 1 + a) % ADLER_MOD
+                if ((b << 16) | a) in weak_index and \
+                        (block_size, strong_sum(view[i + 1:i + 1 + block_size])) in strong_index:
+                    match = i + 1
+                    break
+            scanned += (match or scan_end) - pos
+            if match is None:
+                misses += 1
+                next_scan = scan_end + block_size * (2 ** misses)
+
+        if scanned > DELTA_SCAN_BUDGET:
+            return None
+        pos = match if match is not None else max(scan_end, pos + length)
+        if pos - literal_start > size // 2:
+            return None
+
+    flush_literal(size)
+    if literal_bytes > size // 2:
+        return None
+    return ops
+
+
+class ActionModule(ActionBase):
+    #
+    # Многошаговый запуск my_own_module:
+    #   1. модулю уходят только path + checksum, он сравнивает их с удаленными файлами
+    #      (и для delta возвращает сигнатуры блоков);
+    #   2. content (или только изменившиеся блоки) отправляется только для файлов,
+    #      у которых checksum не совпал;
+    #   3. если delta не сошлась с checksum, файл отправляется целиком.
+    # В устойчивом состоянии по сети передаются только хэши.
+    #
+
+    TRANSFERS_FILES = False
+
+    def _run_items(self, module_name, args, items, task_vars):
+        # Один вызов модуля для списка items; результаты по файлам в том же порядке
+        if args.get('files') is not None:
+            module_args = dict(args, files=items)
+        else:
+            module_args = items[0]
+        module_result = self._execute_module(module_name=module_name, module_args=module_args, task_vars=task_vars)
+        if module_result.get('failed'):
+            return module_result, None
+        if args.get('files') is not None:
+            return module_result, module_result['files']
+        return module_result, [module_result]
+
+    def _run_tree(self, module_name, args, task_vars):
+        #
+        # tree: manifest уходит одним вызовом только с хэшами, затем content отправляется
+        # для файлов из content_required. prune выполняется только в первом вызове -
+        # во втором manifest неполный. Для --check --diff модулю сразу нужен весь content.
+        # Записи, заданные только checksum, отправить нечем - они остаются в content_required
+        #
+        if self._play_context.check_mode and self._task.diff:
+            return self._execute_module(module_name=module_name, module_args=args, task_vars=task_vars)
+
+        items = [dict(item) for item in args['manifest']]
+        if content_size(items) < PROBE_MIN_CONTENT:
+            return self._execute_module(module_name=module_name, module_args=args, task_vars=task_vars)
+        probe_items = []
+        for item in items:
+            checksum = item.get('checksum')
+            if not checksum:
+                plaintext = item_plaintext(item)
+                if plaintext is None:
+                    return self._execute_module(module_name=module_name, module_args=args, task_vars=task_vars)
+                checksum = hashlib.sha256(plaintext).hexdigest()
+            probe = dict(item, checksum=checksum)
+            probe.pop('content', None)
+            probe.pop('content_b64', None)
+            probe_items.append(probe)
+
+        result = self._execute_module(module_name=module_name, module_args=dict(args, manifest=probe_items),
+                                      task_vars=task_vars)
+        if result.get('failed'):
+            return result
+
+        tree = result['tree']
+        sendable = {
+            item['path'] for item in items
+            if item.get('content') is not None or item.get('content_b64') is not None
+        }
+        required = {path for path in tree['content_required'] if path in sendable}
+        tree['content_required'] = [path for path in tree['content_required'] if path not in sendable]
+        if required and not self._play_context.check_mode:
+            write_result = self._execute_module(
+                module_name=module_name,
+                module_args=dict(args, manifest=[item for item in items if item['path'] in required], prune=False),
+                task_vars=task_vars,
+            )
+            if write_result.get('failed'):
+                return write_result
+            tree['created'] += write_result['tree']['created']
+            tree['updated'] += write_result['tree']['updated']
+            tree['attributes_changed'] += write_result['tree']['attributes_changed']
+            if 'diff' in write_result:
+                result['diff'] = write_result['diff'] + result.get('diff', [])
+
+        # Файлы, у которых изменились только mode/owner/group, тоже не unchanged
+        changed_paths = (
+            set(tree['created']) | set(tree['updated']) | set(tree['attributes_changed']) | set(tree['content_required'])
+        )
+        result['changed'] = bool(changed_paths or tree['removed'])
+        result['created'] = bool(tree['created'])
+        result['updated'] = bool(tree['updated'])
+        result['summary'] = dict(
+            total=len(items),
+            created=len(tree['created']),
+            updated=len(tree['updated']),
+            attributes_changed=len(tree['attributes_changed']),
+            unchanged=len(items) - len(changed_paths),
+            removed=len(tree['removed']),
+        )
+        return result
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        module_name = self._task.resolved_action or self._task.action
+        args = self._task.args.copy()
+
+        if args.get('tree') is not None:
+            result.update(self._run_tree(module_name, args, task_vars))
+            return result
+
+        if args.get('files') is not None:
+            items = [dict(item) for item in args['files']]
+        else:
+            items = [dict(args)]
+
+        # Небольшой content - один вызов вместо пробы и записи
+        if content_size(items) < PROBE_MIN_CONTENT:
+            result.update(self._execute_module(module_name=module_name, module_args=args, task_vars=task_vars))
+            return result
+
+        # Шаг 1: проба - только хэши
+        plaintexts = [None] * len(items)
+        probe_items = []
+        for n, item in enumerate(items):
+            checksum = item.get('checksum')
+            if not checksum or item.get('delta'):
+                plaintexts[n] = item_plaintext(item)
+                if plaintexts[n] is not None and not checksum:
+                    checksum = hashlib.sha256(plaintexts[n]).hexdigest()
+            probe = dict(item, checksum=checksum)
+            probe.pop('content', None)
+            probe.pop('content_b64', None)
+            probe_items.append(probe)
+
+        # Хэш посчитать не удалось - обычный одношаговый запуск
+        if any(probe['checksum'] is None for probe in probe_items):
+            result.update(self._execute_module(module_name=module_name, module_args=args, task_vars=task_vars))
+            return result
+
+        probe_result, file_results = self._run_items(module_name, args, probe_items, task_vars)
+        if file_results is None:
+            result.update(probe_result)
+            return result
+
+        required = [n for n, r in enumerate(file_results) if r.pop('content_required', False)]
+        signatures = {n: file_results[n].pop('signatures') for n in required if 'signatures' in file_results[n]}
+
+        diffs = []
+        check_mode = self._play_context.check_mode
+        if required and (not check_mode or self._task.diff):
+            # Шаг 2: изменившиеся блоки или content целиком (в check mode - только ради diff)
+            write_items = []
+            for n in required:
+                ops = None
+                if n in signatures and plaintexts[n] is not None and not check_mode:
+                    ops = compute_delta(plaintexts[n], signatures[n])
+                if ops is not None:
+                    write_items.append(dict(
+                        probe_items[n],
+                        delta_ops=ops,
+                        delta_block_size=signatures[n]['block_size'],
+                    ))
+                else:
+                    write_items.append(items[n])
+
+            write_result, written = self._run_items(module_name, args, write_items, task_vars)
+            if written is None:
+                result.update(write_result)
+                return result
+            for n, file_result in zip(required, written):
+                file_results[n] = file_result
+            if args.get('files') is not None:
+                diffs += write_result.get('diff') or []
+
+            # Шаг 3: delta не сошлась - отправляем content целиком
+            retry = [n for n in required if file_results[n].pop('delta_failed', False)]
+            if retry:
+                retry_result, rewritten = self._run_items(module_name, args, [items[n] for n in retry], task_vars)
+                if rewritten is None:
+                    result.update(retry_result)
+                    return result
+                for n, file_result in zip(retry, rewritten):
+                    file_results[n] = file_result
+                if args.get('files') is not None:
+                    diffs += retry_result.get('diff') or []
+
+        if args.get('files') is None:
+            result.update(file_results[0])
+            return result
+
+        result.update(probe_result)
+        if self._task.diff:
+            result['diff'] = diffs
+        result['changed'] = any(r['changed'] for r in file_results)
+        result['created'] = any(r['created'] for r in file_results)
+        result['updated'] = any(r['updated'] for r in file_results)
+        result['files'] = file_results
+        result['summary'] = dict(
+            total=len(file_results),
+            created=sum(r['created'] for r in file_results),
+            updated=sum(r['updated'] for r in file_results),
+            attributes_changed=sum(bool(r.get('attributes_changed')) for r in file_results),
+            unchanged=sum(not r['changed'] for r in file_results),
+        )
+        return result
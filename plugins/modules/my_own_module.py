@@ -17,19 +17,274 @@ DOCUMENTATION = r'''
 module: my_own_module
 short_description: This is my test module.
 version_added: "1.0.0"
-description: The module creates a text file on a remote host with a given content.
+description:
+    - The module creates a text file on a remote host with a given content.
+    - The paired action plugin first sends only SHA-256 checksums and transfers O(content)
+      just for the files whose remote checksum differs. When all the content of the task is under 64 KiB
+      it is sent in a single call without this probe.
+    - The file is written to a temporary file in the same directory and renamed over the target,
+      so readers see either the old or the new content, never a partially written file.
+      If the path is a symlink, the file it points to is replaced and the link is kept.
+      A symlink whose target directory does not exist is an error.
+      The SELinux context of an existing file is carried over to the new one.
+      A file with several hard links is rewritten in place (not atomically), so all the links see the new content.
+      The mode and ownership of an existing file are preserved unless O(mode), O(owner) or O(group) are set.
+    - O(mode), O(owner) and O(group) are set on the open file while it is written, so a separate
+      M(ansible.builtin.file) task is not needed. For an existing file with the right content they are
+      checked with a single C(stat) and fixed without rewriting the file.
+    - In C(--diff) mode a unified diff is returned. It is computed from line hashes and limited
+      in size, so large files are never held in memory twice.
 options:
     path:
-        description: The path to the file that will be created.
-        required: true
+        description:
+            - The path to the file that will be created.
+            - Required unless O(files) or O(tree) is used.
+        required: false
         type: str
     content:
         description:
             - The contents that will be written to the file.
             - You can indicate both a single-line line and a multi-line YAML block.
+            - If omitted, an empty file is created.
+            - Mutually exclusive with O(content_b64).
+        required: false
+        type: str
+    content_b64:
+        description:
+            - Base64 encoded file contents, for binary files and compressed payloads.
+            - The payload is decoded and decompressed on the remote host block by block,
+              straight into the comparison and the target file.
+            - Mutually exclusive with O(content).
+        required: false
+        type: str
+    content_compression:
+        description:
+            - Compression of the O(content_b64) payload.
+            - V(zstd) requires the C(zstandard) Python library on the remote host.
+        required: false
+        type: str
+        choices: [none, gzip, zstd]
+        default: none
+    delta:
+        description:
+            - Update an existing file by blocks instead of rewriting it.
+            - The action plugin gets block signatures (adler32 + BLAKE2b) of the remote file, finds the
+              unchanged blocks with an rsync-style rolling checksum and sends only the changed ones.
+            - The new file is verified against the SHA-256 of the content before anything is written.
+              It is assembled in a temporary copy and renamed over the target, like a full write,
+              unless O(delta_in_place) is set.
+            - If a delta does not pay off (most blocks changed) the full content is sent.
+        required: false
+        type: bool
+        default: false
+    delta_block_size:
+        description:
+            - Block size in bytes for O(delta).
+            - By default it is chosen from the file size, at least 64 KiB.
+        required: false
+        type: int
+    delta_in_place:
+        description:
+            - With O(delta), write only the changed blocks over the existing file when the block layout
+              is unchanged, instead of assembling a temporary copy.
+            - This is B(not atomic), readers may see a partially updated file and an interrupted write
+              leaves it mixed. Use it for big files where copying the whole file costs too much.
+        required: false
+        type: bool
+        default: false
+    delta_ops:
+        description:
+            - Internal, set by the action plugin for O(delta) updates.
+        required: false
+        type: list
+        elements: raw
+    checksum:
+        description:
+            - SHA-256 hex digest of O(content) (of the decoded and decompressed O(content_b64)),
+              if it is already known on the controller.
+            - Without it the action plugin computes the digest itself.
         required: false
         type: str
-        default: ""
+    files:
+        description:
+            - Manage many files in one module run instead of a loop.
+            - Parent directories are created once per directory.
+            - Mutually exclusive with O(path).
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            path:
+                description: The path to the file.
+                required: true
+                type: str
+            content:
+                description: The contents of the file. If omitted, the file is empty.
+                required: false
+                type: str
+            content_b64:
+                description: Base64 encoded contents of the file, see O(content_b64).
+                required: false
+                type: str
+            content_compression:
+                description: Compression of O(files[].content_b64).
+                required: false
+                type: str
+                choices: [none, gzip, zstd]
+                default: none
+            checksum:
+                description: SHA-256 hex digest of O(files[].content), if it is already known.
+                required: false
+                type: str
+            delta:
+                description: Update this file by blocks, see O(delta).
+                required: false
+                type: bool
+                default: false
+            delta_block_size:
+                description: Block size for O(files[].delta).
+                required: false
+                type: int
+            delta_in_place:
+                description: Write the changed blocks of this file in place, see O(delta_in_place).
+                required: false
+                type: bool
+                default: false
+            mode:
+                description: Permissions of this file, overrides O(mode).
+                required: false
+                type: raw
+            owner:
+                description: Owner of this file, overrides O(owner).
+                required: false
+                type: str
+            group:
+                description: Group of this file, overrides O(group).
+                required: false
+                type: str
+    mode:
+        description:
+            - Permissions of the file, as an octal number, for example V('0644').
+            - Quote it in YAML, or use a leading zero so it is read as an octal number.
+            - Applies to every file of O(files) and O(manifest).
+            - If not set, a new file gets the default mode (C(0666) minus umask)
+              and an existing file keeps its mode.
+        required: false
+        type: raw
+    owner:
+        description:
+            - Name or numeric ID of the user that should own the file.
+            - Applies to every file of O(files) and O(manifest).
+            - Changing the owner requires root.
+        required: false
+        type: str
+    group:
+        description:
+            - Name or numeric ID of the group that should own the file.
+            - Applies to every file of O(files) and O(manifest).
+        required: false
+        type: str
+    dedup:
+        description:
+            - Keep written content in a local content-addressed store on the remote host (keyed by SHA-256)
+              and create target files from it with a C(FICLONE) reflink, so identical files share
+              their data blocks on Btrfs, XFS and other filesystems with reflinks.
+            - Reflink support is checked once per target filesystem. Where it is not available
+              (another filesystem than the store, ext4, ...) files are written directly and the store is not used,
+              so the content is never written twice.
+            - A stored object is checked against its SHA-256 before it is reused; a damaged object is rewritten.
+            - Not used for O(delta) updates.
+            - The module removes old objects only with O(dedup_max_age). Objects can also be removed by hand
+              at any time, for example with C(find <store> -type f -mtime +30 -delete); files cloned from them
+              keep their content.
+        required: false
+        type: bool
+        default: false
+    dedup_store:
+        description:
+            - Directory of the O(dedup) store. It should be on the same filesystem as the target files
+              for reflinks to work.
+        required: false
+        type: path
+        default: ~/.cache/my_own_module/store
+    dedup_max_age:
+        description:
+            - Remove objects of the O(dedup) store that were not used for this many days, at the end of the run.
+            - This walks the whole store, so it costs time proportional to its size.
+        required: false
+        type: int
+    fsync:
+        description:
+            - When written data is flushed to disk.
+            - V(none) leaves it to the filesystem, the rename is still atomic but may be lost on a crash.
+            - V(file) runs C(fsync) on every written file before it is renamed over the target.
+            - V(file+dir) also runs C(fsync) on the directories after the renames, once per directory
+              for the whole run, even if O(files) has thousands of files in it.
+        required: false
+        type: str
+        choices: [none, file, file+dir]
+        default: none
+    tree:
+        description:
+            - Root directory of a tree of files to materialize from O(manifest).
+            - An index of C(path -> size, mtime, sha256) is kept on the remote host,
+              so unchanged files are confirmed by C(stat) without reading them.
+            - Mutually exclusive with O(path) and O(files).
+        required: false
+        type: path
+    manifest:
+        description:
+            - Files of O(tree), with paths relative to it.
+            - Required with O(tree).
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            path:
+                description: The path to the file, relative to O(tree).
+                required: true
+                type: str
+            content:
+                description: The contents of the file.
+                required: false
+                type: str
+            content_b64:
+                description: Base64 encoded contents of the file, see O(content_b64).
+                required: false
+                type: str
+            content_compression:
+                description: Compression of O(manifest[].content_b64).
+                required: false
+                type: str
+                choices: [none, gzip, zstd]
+                default: none
+            checksum:
+                description:
+                    - SHA-256 hex digest of the file.
+                    - An entry with only a checksum is checked but not written, the file is reported
+                      in RV(tree.content_required) if it differs.
+                required: false
+                type: str
+    prune:
+        description:
+            - Remove files under O(tree) that are not in O(manifest),
+              and the directories left empty by that.
+        required: false
+        type: bool
+        default: false
+    tree_index:
+        description:
+            - Path of the index file of O(tree).
+            - By default C(.my_own_module.index) in O(tree). It is never pruned.
+        required: false
+        type: path
+    workers:
+        description:
+            - Number of threads that check and write O(files) or O(manifest) in parallel.
+            - Helps on slow or network filesystems.
+        required: false
+        type: int
+        default: 1
 
 # Specify this value according to your collection
 #
@@ -63,11 +318,69 @@ EXAMPLES = r'''
 - name: Create empty file
   dimosspb-devopscourse.training.my_own_module:
     path: /tmp/empty.txt
+
+# Copy a gzip-compressed binary artifact
+- name: Deploy artifact
+  dimosspb-devopscourse.training.my_own_module:
+    path: /opt/myapp/app.bin
+    content_b64: "{{ lookup('ansible.builtin.pipe', 'gzip -c app.bin | base64 -w0') }}"
+    content_compression: gzip
+
+# Create many files in one module run
+- name: Create configuration files
+  dimosspb-devopscourse.training.my_own_module:
+    workers: 8
+    fsync: file+dir
+    files:
+      - path: /etc/myapp/conf.d/a.conf
+        content: "a = 1"
+      - path: /etc/myapp/conf.d/b.conf
+        content: "b = 2"
+
+# Content, permissions and ownership in one task instead of a separate file task
+- name: Deploy secrets readable only by the application
+  dimosspb-devopscourse.training.my_own_module:
+    owner: myapp
+    group: myapp
+    mode: '0640'
+    files:
+      - path: /etc/myapp/secret.conf
+        content: "token = {{ myapp_token }}"
+      - path: /etc/myapp/run.sh
+        content: "#!/bin/sh\nexec /opt/myapp/bin/myapp"
+        mode: '0750'
+
+# Same large content on many paths: share data blocks through the dedup store
+- name: Deploy the same bundle to every instance directory
+  dimosspb-devopscourse.training.my_own_module:
+    dedup: true
+    dedup_store: /srv/.my_own_module_store
+    files:
+      - path: /srv/app1/bundle.bin
+        content_b64: "{{ bundle_b64 }}"
+      - path: /srv/app2/bundle.bin
+        content_b64: "{{ bundle_b64 }}"
+      - path: /srv/app3/bundle.bin
+        content_b64: "{{ bundle_b64 }}"
+
+# Materialize a directory tree and remove files that are not in it
+- name: Deploy static site
+  dimosspb-devopscourse.training.my_own_module:
+    tree: /srv/www/site
+    prune: true
+    workers: 8
+    manifest: "{{ site_files }}"
+  vars:
+    site_files:
+      - path: index.html
+        content: "<h1>Hello</h1>"
+      - path: css/site.css
+        content: "h1 { color: red; }"
 '''
 
 RETURN = r'''
 changed:
-    description: File was created or its content was changed.
+    description: File was created, its content was changed, or its O(mode), O(owner) or O(group) were changed.
     type: bool
     returned: always
     sample: true
@@ -83,16 +396,1197 @@ updated:
     type: bool
     returned: always
     sample: true
+
+attributes_changed:
+    description:
+        - Attributes of an existing file that differed from O(mode), O(owner) and O(group) and were set,
+          V(mode), V(owner) and/or V(group).
+        - If only they differed, C(created) and C(updated) are false and the content was not rewritten.
+    type: list
+    elements: str
+    returned: when the attributes of an existing file differed
+    sample: [mode, owner]
+
+content_required:
+    description:
+        - Returned by the checksum probe that the action plugin runs first.
+        - The remote file differs from O(checksum), so the content has to be sent.
+    type: bool
+    returned: internal, checksum probe only
+    sample: true
+
+signatures:
+    description:
+        - Block signatures of the remote file, returned by the checksum probe when O(delta) is set
+          and the file exists but differs.
+    type: dict
+    returned: internal, checksum probe with O(delta) only
+
+dedup:
+    description:
+        - How the file was created from the O(dedup) store, V(reflink), V(copy_file_range) or V(copy).
+        - The last two only if the reflink failed for this file although the filesystem supports it.
+    type: str
+    returned: when the file was written from the O(dedup) store
+    sample: reflink
+
+delta:
+    description:
+        - How a O(delta) update was written, V(in_place) (only changed blocks, with O(delta_in_place))
+          or V(rewrite) (temporary copy).
+    type: str
+    returned: when the file was updated by O(delta)
+    sample: rewrite
+
+diff:
+    description:
+        - Unified diff of the changes in C(--diff) mode, a list of them for O(files) and O(tree).
+        - Not returned for files updated by O(delta).
+    type: raw
+    returned: in C(--diff) mode
+    sample:
+        prepared: |
+            --- before: /tmp/hello.txt
+            +++ after: /tmp/hello.txt
+            @@ -1 +1 @@
+            -Hello, World!
+            +Hello!
+
+files:
+    description: Per-file results of O(files), in the same order.
+    type: list
+    elements: dict
+    returned: when O(files) is used
+    sample:
+        - path: /etc/myapp/conf.d/a.conf
+          changed: true
+          created: true
+          updated: false
+
+summary:
+    description:
+        - Counters of O(files) or O(manifest) results.
+        - C(attributes_changed) counts files whose O(mode), O(owner) or O(group) were set,
+          whether or not their content changed.
+        - For O(tree) it also has C(removed), the number of files removed by O(prune).
+    type: dict
+    returned: when O(files) or O(tree) is used
+    sample:
+        total: 2
+        created: 1
+        updated: 0
+        attributes_changed: 0
+        unchanged: 1
+
+tree:
+    description:
+        - Paths of O(manifest) files that were created or updated, that had their O(mode), O(owner) or O(group) set,
+          and of files removed by O(prune), as given in O(manifest) (relative to O(tree)).
+        - C(content_required) lists the checksum-only entries that differ from the remote files.
+    type: dict
+    returned: when O(tree) is used
+    sample:
+        created: [css/site.css]
+        updated: [index.html]
+        attributes_changed: []
+        removed: [old.html]
+        content_required: []
 '''
 
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.basic import AnsibleModule, missing_required_lib
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left
+from difflib import Match, SequenceMatcher
+import base64
+import fcntl
+import grp
+import hashlib
+import json
 import os
+import pwd
+import stat
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+    HAS_ZSTANDARD = True
+    PAYLOAD_ERRORS = (ValueError, zlib.error, zstandard.ZstdError)
+except ImportError:
+    HAS_ZSTANDARD = False
+    PAYLOAD_ERRORS = (ValueError, zlib.error)
+
+# Размер блока при сравнении существующего файла с content
+CHUNK_SIZE = 1024 * 1024
+# Размер куска content_b64, декодируемого за раз (кратен 4)
+B64_CHUNK_SIZE = 4 * 256 * 1024
+# Блоки delta: не меньше 64 KB и не больше ~8192 блоков на файл
+DELTA_MIN_BLOCK_SIZE = 64 * 1024
+DELTA_MAX_BLOCKS = 8192
+# --diff: строки сравниваются по хэшам, текст держится только для выводимых hunk
+DIFF_MAX_LINES = 50000
+DIFF_MAX_OUTPUT_LINES = 1000
+DIFF_CONTEXT = 3
+# ioctl FICLONE из linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Индекс tree
+TREE_INDEX_NAME = '.my_own_module.index'
+TREE_INDEX_VERSION = 1
+
+
+def gzip_blocks(raw_blocks):
+    #
+    # Несколько members подряд (gzip a; gzip b) распаковываются все, как gzip.decompress
+    # на контроллере. Оборванный поток или мусор после него - ошибка, а не обрезанный файл
+    #
+    decompressor = None
+    for raw in raw_blocks:
+        while raw:
+            if decompressor is None or decompressor.eof:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            block = decompressor.decompress(raw, CHUNK_SIZE)
+            if block:
+                yield block
+            raw = decompressor.unused_data if decompressor.eof else decompressor.unconsumed_tail
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError('truncated gzip stream')
+
+
+def zstd_blocks(raw_blocks):
+    # Как и для gzip: все frames подряд, последний должен быть завершен
+    decompressor = None
+    for raw in raw_blocks:
+        while raw:
+            if decompressor is None or decompressor.eof:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+            block = decompressor.decompress(raw)
+            if block:
+                yield block
+            raw = decompressor.unused_data if decompressor.eof else b''
+    if decompressor is not None and not decompressor.eof:
+        raise ValueError('truncated zstd frame')
+
+
+class Payload:
+    #
+    # Содержимое файла как поток блоков. content_b64 декодируется и распаковывается
+    # по мере чтения, полная копия открытого текста в памяти не собирается
+    #
+    def __init__(self, data=None, b64=None, compression='none'):
+        self.data = data
+        self.b64 = b64
+        self.compression = compression
+
+        if data is not None:
+            self.size = len(data)
+        elif compression == 'none':
+            self.size = len(b64) // 4 * 3 - b64[-2:].count('=')
+        else:
+            # Размер распакованных данных заранее неизвестен
+            self.size = None
+
+    @classmethod
+    def from_item(cls, item):
+        if item.get('content_b64') is not None:
+            b64 = item['content_b64']
+            if any(c in b64 for c in '\n\r '):
+                b64 = ''.join(b64.split())
+            return cls(b64=b64, compression=item.get('content_compression') or 'none')
+        return cls(data=(item.get('content') or '').encode('utf-8'))
+
+    def raw_blocks(self):
+        for start in range(0, len(self.b64), B64_CHUNK_SIZE):
+            yield base64.b64decode(self.b64[start:start + B64_CHUNK_SIZE], validate=True)
+
+    def chunks(self):
+        if self.data is not None:
+            view = memoryview(self.data)
+            for offset in range(0, len(view), CHUNK_SIZE):
+                yield view[offset:offset + CHUNK_SIZE]
+        elif self.compression == 'gzip':
+            yield from gzip_blocks(self.raw_blocks())
+        elif self.compression == 'zstd':
+            yield from zstd_blocks(self.raw_blocks())
+        else:
+            yield from self.raw_blocks()
+
+
+class FileAttributes:
+    #
+    # mode / owner / group из параметров. None - атрибут не управляется:
+    # новый файл получает его по умолчанию, у существующего он сохраняется
+    #
+    def __init__(self, mode=None, uid=None, gid=None):
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+
+    @classmethod
+    def from_item(cls, item, defaults=None):
+        # Атрибуты элемента files переопределяют заданные на уровне модуля
+        defaults = defaults or cls()
+        mode = item.get('mode')
+        if mode is not None and not isinstance(mode, int):
+            try:
+                mode = int(str(mode), 8)
+            except ValueError:
+                mode = -1
+        if mode is not None and not 0 <= mode <= 0o7777:
+            raise ValueError(f"mode must be an octal number from 0 to 07777, got {item['mode']!r}")
+        return cls(
+            defaults.mode if mode is None else mode,
+            defaults.uid if item.get('owner') is None else resolve_id(item['owner'], pwd.getpwnam, 'pw_uid'),
+            defaults.gid if item.get('group') is None else resolve_id(item['group'], grp.getgrnam, 'gr_gid'),
+        )
+
+    def changes(self, st):
+        # Какие атрибуты существующего файла отличаются - хватает одного os.stat
+        changed = []
+        if self.mode is not None and stat.S_IMODE(st.st_mode) != self.mode:
+            changed.append('mode')
+        if self.uid is not None and st.st_uid != self.uid:
+            changed.append('owner')
+        if self.gid is not None and st.st_gid != self.gid:
+            changed.append('group')
+        return changed
+
+
+def resolve_id(name, lookup, field):
+    if str(name).isdigit():
+        return int(name)
+    return getattr(lookup(str(name)), field)
+
+
+class SymlinkTargetError(Exception):
+    pass
+
+class FileWriter:
+    #
+    # Запись через временный файл в том же каталоге и os.replace: читатели видят
+    # либо старое, либо новое содержимое целиком. fsync каталогов откладывается
+    # до sync_dirs(), чтобы на весь запуск был один fsync на каталог.
+    # module нужен только для SELinux контекста; без него (бенчмарк) контекст не переносится
+    #
+    def __init__(self, fsync='none', module=None):
+        self.fsync = fsync
+        self.module = module if module is not None and module.selinux_enabled() else None
+        self.dirty_dirs = set()
+        # umask нельзя прочитать, не изменив его, поэтому делаем это один раз до потоков
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self.euid = os.geteuid()
+        self.groups = set(os.getgroups()) | {os.getegid()}
+
+    def can_replace(self, st, attrs):
+        # Замена разорвала бы hardlink - такой файл переписываем на месте
+        if st is not None and st.st_nlink > 1:
+            return False
+        # Копию с чужим owner/group (сохраненным или заданным) создать может только root
+        uid = attrs.uid if attrs.uid is not None else st.st_uid if st is not None else None
+        gid = attrs.gid if attrs.gid is not None else st.st_gid if st is not None else None
+        if self.euid == 0:
+            return True
+        return uid in (None, self.euid) and (gid is None or gid in self.groups)
+
+    def apply_attributes(self, fd, st, attrs):
+        #
+        # owner/group и mode на открытом файле: заданные в attrs, иначе те, что были у st.
+        # chown сбрасывает setuid/setgid, поэтому mode ставим после него
+        #
+        current = os.fstat(fd)
+        uid = attrs.uid if attrs.uid is not None else st.st_uid if st is not None else current.st_uid
+        gid = attrs.gid if attrs.gid is not None else st.st_gid if st is not None else current.st_gid
+        if (uid, gid) != (current.st_uid, current.st_gid):
+            os.fchown(fd, uid, gid)
+            current = os.fstat(fd)
+        if attrs.mode is not None:
+            mode = attrs.mode
+        elif st is not None:
+            mode = stat.S_IMODE(st.st_mode)
+        else:
+            mode = 0o666 & ~self.umask
+        if mode != stat.S_IMODE(current.st_mode):
+            os.fchmod(fd, mode)
+
+    def set_attributes(self, abs_path, st, attrs):
+        #
+        # Только атрибуты, без перезаписи содержимого. По пути, а не через open: файл без права
+        # на чтение (0200, 0000) тоже должен исправляться, а open FIFO заблокировался бы.
+        # Как и replace, идем по symlink к самому файлу
+        #
+        uid = attrs.uid if attrs.uid is not None else st.st_uid
+        gid = attrs.gid if attrs.gid is not None else st.st_gid
+        mode = attrs.mode if attrs.mode is not None else stat.S_IMODE(st.st_mode)
+        current_mode = stat.S_IMODE(st.st_mode)
+        if (uid, gid) != (st.st_uid, st.st_gid):
+            os.chown(abs_path, uid, gid)
+            # chown сбрасывает setuid/setgid
+            current_mode = stat.S_IMODE(os.stat(abs_path).st_mode)
+        if mode != current_mode:
+            os.chmod(abs_path, mode)
+
+    def sync_file(self, f):
+        if self.fsync != 'none':
+            f.flush()
+            os.fsync(f.fileno())
+
+    def mark_dir(self, directory):
+        if self.fsync == 'file+dir':
+            self.dirty_dirs.add(directory)
+
+    def write(self, abs_path, chunks, st=None, attrs=None):
+        def fill(f):
+            for chunk in chunks:
+                f.write(chunk)
+        self.replace(abs_path, fill, st, attrs)
+
+    def clone(self, abs_path, source, st=None, attrs=None):
+        # Копия объекта из ContentStore; возвращает способ копирования
+        with open(source, 'rb') as src:
+            return self.replace(abs_path, lambda f: clone_file(src, f), st, attrs)
+
+    def replace(self, abs_path, fill, st=None, attrs=None):
+        #
+        # fill(f) пишет содержимое в открытый файл.
+        # st - os.stat() существующего файла, его mode и owner переносятся на новый,
+        # если attrs не задают другие.
+        # Если owner сохранить нельзя или у файла несколько hardlink, он переписывается на месте.
+        # symlink не заменяем файлом: временный файл создается рядом с тем, на что он указывает
+        #
+        attrs = attrs or FileAttributes()
+        if os.path.islink(abs_path):
+            target = os.path.realpath(abs_path)
+            if not os.path.isdir(os.path.dirname(target)):
+                raise SymlinkTargetError(
+                    f"{abs_path} is a symlink to {target}, whose directory does not exist"
+                )
+            abs_path = target
+        if not self.can_replace(st, attrs):
+            with open(abs_path, 'wb') as f:
+                filled = fill(f)
+                self.apply_attributes(f.fileno(), st, attrs)
+                self.sync_file(f)
+            return filled
+
+        directory, name = os.path.split(abs_path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + name + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                filled = fill(f)
+                self.apply_attributes(fd, st, attrs)
+                self.sync_file(f)
+            if self.module is not None and st is not None:
+                # Временный файл получил контекст каталога, а не заменяемого файла
+                context = self.module.selinux_context(abs_path)
+                self.module.set_context_if_different(tmp_path, context, False)
+            os.replace(tmp_path, abs_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.mark_dir(directory)
+        return filled
+
+    def sync_dirs(self):
+        for directory in sorted(self.dirty_dirs):
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.dirty_dirs.clear()
+
+
+def clone_file(src, dst):
+    #
+    # reflink (общие экстенты), иначе copy_file_range (копирование в ядре),
+    # иначе обычное копирование блоками. Возвращает, какой способ сработал
+    #
+    dst.flush()
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 'reflink'
+    except OSError:
+        pass
+
+    size = os.fstat(src.fileno()).st_size
+    if hasattr(os, 'copy_file_range'):
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError:
+            pass
+        if offset == size:
+            return 'copy_file_range'
+
+    src.seek(0)
+    dst.seek(0)
+    dst.truncate()
+    for block in iter(lambda: src.read(CHUNK_SIZE), b''):
+        dst.write(block)
+    return 'copy'
+
+
+class ContentStore:
+    #
+    # Хранилище содержимого по sha256: <root>/<sha[:2]>/<sha>, объекты только для чтения.
+    # Имя нового объекта - sha256, посчитанный при его записи, а не переданный checksum.
+    # Существующий объект перед использованием хэшируется заново: битый или подмененный
+    # объект не должен размножиться во все клонированные из него файлы
+    #
+    def __init__(self, root, writer):
+        self.root = root
+        self.writer = writer
+        self.lock = threading.Lock()
+        # st_dev каталога цели -> поддерживается ли reflink из хранилища
+        self.reflink = {}
+        os.makedirs(root, mode=0o700, exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def can_reflink(self, abs_path):
+        #
+        # Без reflink клон - вторая полная запись того же содержимого, хуже обычной записи.
+        # Проверяется один раз на файловую систему цели на пробном файле из одного байта
+        #
+        directory = os.path.dirname(os.path.realpath(abs_path))
+        dev = os.stat(directory).st_dev
+        with self.lock:
+            if dev in self.reflink:
+                return self.reflink[dev]
+        with tempfile.TemporaryFile(dir=self.root) as src, tempfile.TemporaryFile(dir=directory) as dst:
+            src.write(b'\0')
+            src.flush()
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                supported = True
+            except OSError:
+                supported = False
+        with self.lock:
+            self.reflink[dev] = supported
+        return supported
+
+    def verify(self, path, digest):
+        try:
+            if file_checksum(path) != digest:
+                return False
+        except FileNotFoundError:
+            return False
+        # Возраст для prune считается от последнего использования объекта
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def add(self, payload, checksum=None):
+        # Возвращает (sha256, путь объекта); payload распаковывается один раз - хэш считается при записи
+        if checksum:
+            digest = checksum.lower()
+            if self.verify(self.object_path(digest), digest):
+                return digest, self.object_path(digest)
+
+        sha256 = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in payload.chunks():
+                    sha256.update(chunk)
+                    f.write(chunk)
+                os.fchmod(fd, 0o444)
+                self.writer.sync_file(f)
+            digest = sha256.hexdigest()
+            path = self.object_path(digest)
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            # Свежезаписанный объект заменяет и существующий, даже если тот был испорчен
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.writer.mark_dir(os.path.dirname(path))
+        return digest, path
+
+    def prune(self, max_age):
+        # Удаляет объекты, не использованные max_age дней. Клонированные из них файлы не затрагиваются
+        cutoff = time.time() - max_age * 86400
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.lstat(path).st_mtime < cutoff:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+def content_differs(abs_path, payload, st):
+    #
+    # Сначала сравниваем размер (если он известен), затем файл читается блоками
+    # до первого отличия, так что память не зависит от размера файла
+    #
+    if payload.size is not None and st.st_size != payload.size:
+        return True
+
+    with open(abs_path, 'rb') as f:
+        for chunk in payload.chunks():
+            if f.read(len(chunk)) != chunk:
+                return True
+        return f.read(1) != b''
+
+
+def file_chunks(abs_path):
+    with open(abs_path, 'rb') as f:
+        yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+
+
+def file_checksum(abs_path):
+    sha256 = hashlib.sha256()
+    for block in file_chunks(abs_path):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+def iter_lines(chunks):
+    # Строки из потока блоков; строка длиннее блока режется, чтобы не копить ее целиком
+    tail = b''
+    for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+        if len(tail) > CHUNK_SIZE:
+            yield tail
+            tail = b''
+    if tail:
+        yield tail
+
+
+def line_hashes(chunks):
+    hashes = []
+    for line in iter_lines(chunks):
+        if len(hashes) == DIFF_MAX_LINES:
+            return None
+        hashes.append(hash(line))
+    return hashes
+
+
+class LineMatcher(SequenceMatcher):
+    #
+    # SequenceMatcher по хэшам строк с поиском совпадений как в patience diff:
+    # якоря - строки, уникальные в обеих сторонах, а SequenceMatcher работает только
+    # на участках между ними. Иначе на больших файлах с множеством правок он квадратичен
+    #
+    def get_matching_blocks(self):
+        if self.matching_blocks is None:
+            blocks = []
+            self.match_range(0, len(self.a), 0, len(self.b), blocks)
+            merged = []
+            for i, j, size in blocks:
+                if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+                    merged[-1][2] += size
+                elif size:
+                    merged.append([i, j, size])
+            merged.append([len(self.a), len(self.b), 0])
+            self.matching_blocks = [Match(*block) for block in merged]
+        return self.matching_blocks
+
+    def match_range(self, alo, ahi, blo, bhi, blocks):
+        a, b = self.a, self.b
+        # Общие начало и конец
+        start = alo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        blocks.append((start, blo - (alo - start), alo - start))
+        end = ahi
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        tail = (ahi, bhi, end - ahi)
+        if alo == ahi or blo == bhi:
+            blocks.append(tail)
+            return
+
+        counts = {}
+        for i in range(alo, ahi):
+            counts[a[i]] = -1 if a[i] in counts else i
+        unique_b = {}
+        for j in range(blo, bhi):
+            if counts.get(b[j], -1) >= 0:
+                unique_b[b[j]] = -1 if b[j] in unique_b else j
+        pairs = sorted((counts[line], j) for line, j in unique_b.items() if j >= 0)
+
+        # Наибольшая возрастающая по j подпоследовательность пар - якоря
+        tops = []
+        top_index = []
+        prev = [None] * len(pairs)
+        for n, (i, j) in enumerate(pairs):
+            k = bisect_left(tops, j)
+            prev[n] = top_index[k - 1] if k else None
+            if k == len(tops):
+                tops.append(j)
+                top_index.append(n)
+            else:
+                tops[k] = j
+                top_index[k] = n
+        anchors = []
+        n = top_index[-1] if top_index else None
+        while n is not None:
+            anchors.append(pairs[n])
+            n = prev[n]
+        anchors.reverse()
+
+        if not anchors:
+            for i, j, size in SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False).get_matching_blocks():
+                blocks.append((alo + i, blo + j, size))
+        else:
+            for i, j in anchors:
+                self.match_range(alo, i, blo, j, blocks)
+                blocks.append((i, j, 1))
+                alo, blo = i + 1, j + 1
+            self.match_range(alo, ahi, blo, bhi, blocks)
+        blocks.append(tail)
+
+
+def diff_range(start, stop):
+    # Диапазон строк в заголовке hunk, как в difflib.unified_diff
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    return f'{start + 1 if length else start},{length}'
+
+
+def file_diff(abs_path, payload, file_exist):
+    #
+    # Unified diff для --diff. Первый проход - только хэши строк обеих сторон и
+    # SequenceMatcher по ним, второй - текст строк, попадающих в выводимые hunk.
+    # Сверх DIFF_MAX_LINES строк или DIFF_MAX_OUTPUT_LINES строк вывода - краткая сводка
+    #
+    def before():
+        return file_chunks(abs_path) if file_exist else iter(())
+
+    header = f'--- before: {abs_path}\n+++ after: {abs_path}\n'
+    old_size = os.stat(abs_path).st_size if file_exist else 0
+
+    first_before = next(before(), b'')
+    first_after = bytes(next(payload.chunks(), b''))
+    if b'\0' in first_before or b'\0' in first_after:
+        return dict(prepared=header + f'Binary files differ ({old_size} bytes before)\n')
+
+    old_hashes = line_hashes(before())
+    new_hashes = line_hashes(payload.chunks())
+    if old_hashes is None or new_hashes is None:
+        return dict(prepared=header + f'# diff not shown: more than {DIFF_MAX_LINES} lines ({old_size} bytes before)\n')
+
+    # Hunk, не влезающий в DIFF_MAX_OUTPUT_LINES, обрезается, остальные только считаются
+    groups = []
+    budget = DIFF_MAX_OUTPUT_LINES
+    omitted_hunks = 0
+    for group in LineMatcher(None, old_hashes, new_hashes).get_grouped_opcodes(DIFF_CONTEXT):
+        if budget <= 0:
+            omitted_hunks += 1
+            continue
+        trimmed = []
+        for tag, i1, i2, j1, j2 in group:
+            old_count = min(i2 - i1, budget)
+            budget -= old_count
+            new_count = old_count if tag == 'equal' else min(j2 - j1, budget)
+            if tag != 'equal':
+                budget -= new_count
+            if old_count or new_count:
+                trimmed.append((tag, i1, i1 + old_count, j1, j1 + new_count))
+        if trimmed != group:
+            omitted_hunks += 1
+        if trimmed:
+            groups.append(trimmed)
+    del old_hashes, new_hashes
+
+    # Текст нужен только для строк выводимых hunk
+    old_needed = set()
+    new_needed = set()
+    for group in groups:
+        for tag, i1, i2, j1, j2 in group:
+            old_needed.update(range(i1, i2))
+            if tag != 'equal':
+                new_needed.update(range(j1, j2))
+    old_lines = {n: line for n, line in enumerate(iter_lines(before())) if n in old_needed}
+    new_lines = {n: line for n, line in enumerate(iter_lines(payload.chunks())) if n in new_needed}
+
+    def text(line):
+        line = line.decode('utf-8', errors='replace')
+        return line if line.endswith('\n') else line + '\n\\ No newline at end of file\n'
+
+    out = [header]
+    for group in groups:
+        first, last = group[0], group[-1]
+        out.append(f'@@ -{diff_range(first[1], last[2])} +{diff_range(first[3], last[4])} @@\n')
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                out.extend(' ' + text(old_lines[n]) for n in range(i1, i2))
+                continue
+            out.extend('-' + text(old_lines[n]) for n in range(i1, i2))
+            out.extend('+' + text(new_lines[n]) for n in range(j1, j2))
+    if omitted_hunks:
+        out.append(f'# diff truncated to {DIFF_MAX_OUTPUT_LINES} lines, {omitted_hunks} hunks not shown in full\n')
+    return dict(prepared=''.join(out))
+
+
+def delta_block_size(size, requested=None):
+    if requested:
+        return requested
+    block_size = max(DELTA_MIN_BLOCK_SIZE, -(-size // DELTA_MAX_BLOCKS))
+    # Округляем до 4 KB
+    return -(-block_size // 4096) * 4096
+
+
+def block_signatures(abs_path, block_size):
+    #
+    # Слабая (adler32, как в rsync - скользящая) и сильная (BLAKE2b) сумма каждого блока
+    #
+    blocks = []
+    with open(abs_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            blocks.append([zlib.adler32(block), hashlib.blake2b(block, digest_size=16).hexdigest()])
+    return dict(
+        block_size=block_size,
+        size=os.stat(abs_path).st_size,
+        blocks=blocks,
+    )
+
+
+def delta_chunks(f, ops, block_size):
+    #
+    # Новое содержимое из старого файла f и операций delta:
+    #   ['copy', k, n] - n старых блоков, начиная с k
+    #   ['data', b64]  - новые байты
+    #
+    for op in ops:
+        if op[0] == 'copy':
+            f.seek(op[1] * block_size)
+            remaining = op[2] * block_size
+            while remaining:
+                block = f.read(min(CHUNK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+        else:
+            yield base64.b64decode(op[1], validate=True)
+
+
+def apply_delta(abs_path, ops, block_size, checksum, writer, attrs, allow_in_place=False):
+    #
+    # Сначала собираем новое содержимое в памяти блоками только для проверки sha256,
+    # и лишь при совпадении пишем: во временную копию с os.replace, либо, если это
+    # разрешено (неатомарно) и раскладка блоков не изменилась, поверх измененных блоков
+    #
+    st = os.stat(abs_path)
+    size = st.st_size
+    in_place = allow_in_place
+    offset = 0
+    for op in ops:
+        if op[0] == 'copy':
+            if op[1] * block_size != offset:
+                in_place = False
+            length = max(0, min(op[2] * block_size, size - op[1] * block_size))
+        else:
+            length = len(op[1]) // 4 * 3 - op[1][-2:].count('=')
+        offset += length
+    if offset != size:
+        in_place = False
+
+    sha256 = hashlib.sha256()
+    with open(abs_path, 'rb') as f:
+        for chunk in delta_chunks(f, ops, block_size):
+            sha256.update(chunk)
+    if sha256.hexdigest() != checksum.lower():
+        return None
+    # Копию, сохранив owner, не создать, а переписать файл на месте, читая его же, нельзя
+    if not in_place and not writer.can_replace(st, attrs):
+        return None
+
+    if in_place:
+        with open(abs_path, 'r+b') as f:
+            offset = 0
+            for op in ops:
+                if op[0] == 'copy':
+                    offset += op[2] * block_size
+                else:
+                    data = base64.b64decode(op[1], validate=True)
+                    f.seek(offset)
+                    f.write(data)
+                    offset += len(data)
+            writer.apply_attributes(f.fileno(), st, attrs)
+            writer.sync_file(f)
+        return 'in_place'
+
+    with open(abs_path, 'rb') as f:
+        writer.write(abs_path, delta_chunks(f, ops, block_size), st, attrs)
+    return 'rewrite'
+
+
+def apply_file(abs_path, payload, check_mode, writer, checksum=None, delta=False, block_size=None, delta_ops=None,
+               diff=False, store=None, attrs=None, delta_in_place=False):
+    #
+    # payload is None - это проба от action plugin: сравниваем только checksum
+    # и ничего не пишем, а сообщаем, нужен ли content.
+    # mode/owner/group проверяются по тому же os.stat; если отличаются только они,
+    # содержимое не переписывается
+    #
+    result = dict(
+        changed=False,
+        created=False,
+        updated=False,
+    )
+    attrs = attrs or FileAttributes()
+
+    try:
+        st = os.stat(abs_path)
+    except FileNotFoundError:
+        st = None
+    file_exist = st is not None
+    attributes_changed = attrs.changes(st) if file_exist else []
+    if attributes_changed:
+        result['changed'] = True
+        result['attributes_changed'] = attributes_changed
+
+    # Обновление по delta от action plugin
+    if delta_ops is not None:
+        if not file_exist:
+            result['delta_failed'] = True
+            return result
+        if check_mode:
+            result['changed'] = True
+            result['updated'] = True
+            return result
+        written = apply_delta(abs_path, delta_ops, block_size, checksum, writer, attrs, delta_in_place)
+        if written is None:
+            result['delta_failed'] = True
+        else:
+            result['changed'] = True
+            result['updated'] = True
+            result['delta'] = written
+        return result
+
+    if payload is None:
+        content_changed = file_exist and file_checksum(abs_path) != checksum.lower()
+    else:
+        content_changed = file_exist and content_differs(abs_path, payload, st)
+
+    if not file_exist:
+        result['changed'] = True
+        result['created'] = True
+    elif content_changed:
+        result['changed'] = True
+        result['updated'] = True
+
+    if attributes_changed and not content_changed and not check_mode:
+        writer.set_attributes(abs_path, st, attrs)
+
+    if payload is None:
+        result['content_required'] = result['created'] or result['updated']
+        # Если delta все равно не записать (копию с тем же owner не создать, hardlink), сигнатуры
+        # не отдаем: action plugin сразу пришлет content, без третьего вызова после delta_failed
+        if delta and content_changed and (delta_in_place or writer.can_replace(st, attrs)):
+            result['signatures'] = block_signatures(abs_path, delta_block_size(st.st_size, block_size))
+    elif result['created'] or result['updated']:
+        if diff:
+            result['diff'] = file_diff(abs_path, payload, file_exist)
+        if check_mode:
+            pass
+        elif store is not None and store.can_reflink(abs_path):
+            result['dedup'] = writer.clone(abs_path, store.add(payload, checksum)[1], st, attrs)
+        else:
+            writer.write(abs_path, payload.chunks(), st, attrs)
+
+    return result
+
+
+def make_dirs(directories, writer):
+    # Каждый каталог создаем один раз, даже если в нем тысячи файлов
+    for directory in sorted(set(directories)):
+        # Записи о новых каталогах в их родителях тоже должны пережить сбой
+        missing = directory
+        while not os.path.isdir(missing):
+            writer.mark_dir(os.path.dirname(missing))
+            missing = os.path.dirname(missing)
+        os.makedirs(directory, exist_ok=True)
+
+
+def hashed_chunks(chunks, sha256):
+    for chunk in chunks:
+        sha256.update(chunk)
+        yield chunk
+
+
+def load_tree_index(index_path):
+    #
+    # Индекс tree: {относительный путь: [size, mtime_ns, sha256]}.
+    # Вместе с ним возвращается mtime самого индекса: записи с mtime файла не раньше него
+    # не доверяем - файл могли изменить в тот же квант mtime, в который мы его записали
+    #
+    try:
+        with open(index_path, 'rb') as f:
+            index_mtime = os.fstat(f.fileno()).st_mtime_ns
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}, 0
+    if not isinstance(data, dict) or data.get('version') != TREE_INDEX_VERSION:
+        return {}, 0
+    return data.get('files') or {}, index_mtime
+
+
+def save_tree_index(index_path, index, writer):
+    data = json.dumps(dict(version=TREE_INDEX_VERSION, files=index), separators=(',', ':'))
+    writer.write(index_path, [data.encode('utf-8')], os.stat(index_path) if os.path.exists(index_path) else None)
+
+
+def tree_entry(abs_path, item, payload, check_mode, writer, indexed, index_mtime, diff=False, store=None, attrs=None):
+    #
+    # Возвращает результат по файлу и новую запись индекса (или None, если она не изменилась).
+    # Файл читается только если размер совпал, а запись индекса для него устарела
+    #
+    result = dict(
+        changed=False,
+        created=False,
+        updated=False,
+    )
+    checksum = item['checksum'].lower() if item['checksum'] else None
+    entry = None
+
+    try:
+        st = os.stat(abs_path)
+    except FileNotFoundError:
+        st = None
+
+    if st is None:
+        result['created'] = True
+    elif payload is not None and payload.size is not None and payload.size != st.st_size:
+        result['updated'] = True
+    else:
+        if indexed is not None and indexed[0] == st.st_size and indexed[1] == st.st_mtime_ns < index_mtime:
+            current = indexed[2]
+        else:
+            current = file_checksum(abs_path)
+            entry = [st.st_size, st.st_mtime_ns, current]
+        if checksum is None:
+            sha256 = hashlib.sha256()
+            for chunk in payload.chunks():
+                sha256.update(chunk)
+            checksum = sha256.hexdigest()
+        result['updated'] = current != checksum
+
+    result['changed'] = result['created'] or result['updated']
+    if result['changed'] and payload is not None and diff:
+        result['diff'] = file_diff(abs_path, payload, st is not None)
+
+    # mode/owner/group - по тому же stat; если отличаются только они, файл не переписываем
+    attributes_changed = attrs.changes(st) if attrs is not None and st is not None else []
+    if attributes_changed:
+        result['attributes_changed'] = attributes_changed
+        if not result['changed'] and not check_mode:
+            writer.set_attributes(abs_path, st, attrs)
+
+    if not result['changed'] or check_mode:
+        result['changed'] |= bool(attributes_changed)
+        return result, entry
+    if payload is None:
+        result['content_required'] = True
+        return result, entry
+
+    if store is not None and store.can_reflink(abs_path):
+        digest, source = store.add(payload, checksum)
+        writer.clone(abs_path, source, st, attrs)
+    else:
+        sha256 = hashlib.sha256()
+        writer.write(abs_path, hashed_chunks(payload.chunks(), sha256), st, attrs)
+        digest = sha256.hexdigest()
+    st = os.stat(abs_path)
+    return result, [st.st_size, st.st_mtime_ns, digest]
+
+
+def prune_tree(root, keep, index_path, check_mode, writer):
+    #
+    # Удаляет файлы вне manifest и каталоги, которые после этого опустели.
+    # Пустые каталоги, в которых ничего не удаляли, не трогаем
+    #
+    removed = []
+    pruned_dirs = set()
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        rel_dir = os.path.relpath(dirpath, root)
+        for name in filenames:
+            rel = name if rel_dir == os.curdir else os.path.join(rel_dir, name)
+            if rel in keep:
+                continue
+            abs_path = os.path.join(dirpath, name)
+            if abs_path == index_path:
+                continue
+            removed.append(rel)
+            if not check_mode:
+                os.unlink(abs_path)
+                writer.mark_dir(dirpath)
+                pruned_dirs.add(dirpath)
+        if dirpath in pruned_dirs and dirpath != root and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+            writer.mark_dir(os.path.dirname(dirpath))
+            pruned_dirs.add(os.path.dirname(dirpath))
+    return sorted(removed)
+
+
+def apply_tree(module, writer, store, run_parallel, attrs):
+    params = module.params
+    root = os.path.abspath(os.path.expanduser(params['tree']))
+    index_path = os.path.abspath(os.path.expanduser(params['tree_index'] or os.path.join(root, TREE_INDEX_NAME)))
+    items = params['manifest']
+
+    rels = []
+    for item in items:
+        rel = os.path.normpath(item['path'])
+        if os.path.isabs(rel) or rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            module.fail_json(msg=f"Manifest path must be relative to tree and stay inside it: {item['path']}")
+        # '' и '.' - это сам tree; каталог файлом не заменяем, индекс тоже
+        if rel == os.curdir or item['path'].endswith(os.sep) or os.path.isdir(os.path.join(root, rel)):
+            module.fail_json(msg=f"Manifest path must name a file, not a directory: {item['path']!r}")
+        if os.path.join(root, rel) == index_path:
+            module.fail_json(msg=f"Manifest path is the tree index: {item['path']}")
+        rels.append(rel)
+    paths = [os.path.join(root, rel) for rel in rels]
+
+    index, index_mtime = load_tree_index(index_path)
+
+    if not module.check_mode:
+        make_dirs([root] + [os.path.dirname(abs_path) for abs_path in paths], writer)
+
+    def apply_item(n):
+        item = items[n]
+        probe = item['content'] is None and item['content_b64'] is None and item['checksum'] is not None
+        payload = None if probe else Payload.from_item(item)
+        return tree_entry(
+            paths[n], item, payload, module.check_mode, writer, index.get(rels[n]), index_mtime, module._diff, store,
+            attrs,
+        )
+
+    entries = run_parallel(apply_item, len(items))
+
+    index_changed = False
+    diffs = []
+    tree = dict(created=[], updated=[], attributes_changed=[], removed=[], content_required=[])
+    unchanged = 0
+    for item, rel, (file_result, entry) in zip(items, rels, entries):
+        if 'diff' in file_result:
+            diffs.append(file_result['diff'])
+        if entry is not None:
+            index[rel] = entry
+            index_changed = True
+        if file_result.get('content_required'):
+            tree['content_required'].append(item['path'])
+        elif file_result['created']:
+            tree['created'].append(item['path'])
+        elif file_result['updated']:
+            tree['updated'].append(item['path'])
+        elif not file_result['changed']:
+            unchanged += 1
+        if file_result.get('attributes_changed') and not file_result.get('content_required'):
+            tree['attributes_changed'].append(item['path'])
+
+    if params['prune'] and os.path.isdir(root):
+        tree['removed'] = prune_tree(root, set(rels), index_path, module.check_mode, writer)
+        for rel in tree['removed']:
+            index_changed |= index.pop(rel, None) is not None
+
+    if index_changed and not module.check_mode:
+        save_tree_index(index_path, index, writer)
+
+    if module._diff:
+        for rel in tree['removed']:
+            diffs.append(dict(prepared=f'--- before: {os.path.join(root, rel)}\n+++ after: (removed)\n'))
+
+    result = dict(
+        changed=bool(
+            tree['created'] or tree['updated'] or tree['attributes_changed'] or tree['removed'] or tree['content_required']
+        ),
+        created=bool(tree['created']),
+        updated=bool(tree['updated']),
+        tree=tree,
+        summary=dict(
+            total=len(items),
+            created=len(tree['created']),
+            updated=len(tree['updated']),
+            attributes_changed=len(tree['attributes_changed']),
+            unchanged=unchanged,
+            removed=len(tree['removed']),
+        ),
+    )
+    if module._diff:
+        result['diff'] = diffs
+    return result
 
 
 def run_module():
     module_args = dict(
-        path=dict(type='str', required=True),
-        content=dict(type='str', required=False, default='')
+        path=dict(type='str', required=False),
+        content=dict(type='str', required=False),
+        content_b64=dict(type='str', required=False),
+        content_compression=dict(type='str', required=False, default='none', choices=['none', 'gzip', 'zstd']),
+        checksum=dict(type='str', required=False),
+        delta=dict(type='bool', required=False, default=False),
+        delta_block_size=dict(type='int', required=False),
+        delta_in_place=dict(type='bool', required=False, default=False),
+        delta_ops=dict(type='list', elements='raw', required=False),
+        files=dict(
+            type='list',
+            elements='dict',
+            required=False,
+            options=dict(
+                path=dict(type='str', required=True),
+                content=dict(type='str', required=False),
+                content_b64=dict(type='str', required=False),
+                content_compression=dict(type='str', required=False, default='none', choices=['none', 'gzip', 'zstd']),
+                checksum=dict(type='str', required=False),
+                delta=dict(type='bool', required=False, default=False),
+                delta_block_size=dict(type='int', required=False),
+                delta_in_place=dict(type='bool', required=False, default=False),
+                delta_ops=dict(type='list', elements='raw', required=False),
+                mode=dict(type='raw', required=False),
+                owner=dict(type='str', required=False),
+                group=dict(type='str', required=False),
+            ),
+            mutually_exclusive=[('content', 'content_b64')],
+            required_by={'delta_ops': ('checksum', 'delta_block_size')},
+        ),
+        tree=dict(type='path', required=False),
+        manifest=dict(
+            type='list',
+            elements='dict',
+            required=False,
+            options=dict(
+                path=dict(type='str', required=True),
+                content=dict(type='str', required=False),
+                content_b64=dict(type='str', required=False),
+                content_compression=dict(type='str', required=False, default='none', choices=['none', 'gzip', 'zstd']),
+                checksum=dict(type='str', required=False),
+            ),
+            mutually_exclusive=[('content', 'content_b64')],
+        ),
+        prune=dict(type='bool', required=False, default=False),
+        tree_index=dict(type='path', required=False),
+        mode=dict(type='raw', required=False),
+        owner=dict(type='str', required=False),
+        group=dict(type='str', required=False),
+        dedup=dict(type='bool', required=False, default=False),
+        dedup_store=dict(type='path', required=False, default='~/.cache/my_own_module/store'),
+        dedup_max_age=dict(type='int', required=False),
+        fsync=dict(type='str', required=False, default='none', choices=['none', 'file', 'file+dir']),
+        workers=dict(type='int', required=False, default=1),
     )
 
     result = dict(
@@ -103,41 +1597,117 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('path', 'files', 'tree')],
+        mutually_exclusive=[('path', 'files', 'tree'), ('content', 'content_b64')],
+        required_together=[('tree', 'manifest')],
+        required_by={'delta_ops': ('checksum', 'delta_block_size')},
         supports_check_mode=True
     )
 
-    path = module.params['path']
-    abs_path = os.path.abspath(os.path.expanduser(path))
-    content = module.params['content']
+    if module.params['tree'] is not None:
+        items = module.params['manifest']
+    elif module.params['files'] is None:
+        items = [module.params]
+    else:
+        items = module.params['files']
 
-    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-    file_exist = os.path.exists(abs_path)
-    old_content = None
+    if not HAS_ZSTANDARD and any(
+        item['content_b64'] is not None and item['content_compression'] == 'zstd' for item in items
+    ):
+        module.fail_json(msg=missing_required_lib('zstandard'))
 
-    if file_exist:
-        with open(abs_path, 'r', encoding='utf-8') as f:
-            old_content = f.read()
+    # Имена owner/group и mode разбираются один раз на элемент, а не в потоках записи
+    try:
+        attrs = FileAttributes.from_item(module.params)
+        if module.params['files'] is not None:
+            item_attrs = [FileAttributes.from_item(item, attrs) for item in items]
+        else:
+            item_attrs = [attrs] * len(items)
+    except KeyError as e:
+        module.fail_json(msg=f"Unknown owner or group: {e.args[0]}")
+    except ValueError as e:
+        module.fail_json(msg=str(e))
 
-    if module.check_mode:
-        if not file_exist:
-            result['changed'] = True
-            result['created'] = True
-        elif old_content != content:
-            result['changed'] = True
-            result['updated'] = True
+    writer = FileWriter(module.params['fsync'], module)
+    store = None
+    if module.params['dedup'] and not module.check_mode:
+        store = ContentStore(module.params['dedup_store'], writer)
+
+    def run_parallel(func, count):
+        if module.params['workers'] > 1 and count > 1:
+            with ThreadPoolExecutor(max_workers=module.params['workers']) as executor:
+                return list(executor.map(func, range(count)))
+        return [func(n) for n in range(count)]
+
+    if module.params['tree'] is not None:
+        try:
+            result = apply_tree(module, writer, store, run_parallel, attrs)
+        except PAYLOAD_ERRORS as e:
+            module.fail_json(msg=f"Invalid content_b64 payload: {e}")
+        except PermissionError as e:
+            # Например, owner/group без root
+            module.fail_json(msg=f"Permission denied: {e}")
+        except SymlinkTargetError as e:
+            module.fail_json(msg=str(e))
+        if store is not None and module.params['dedup_max_age'] is not None:
+            store.prune(module.params['dedup_max_age'])
+        writer.sync_dirs()
         module.exit_json(**result)
 
-    if not file_exist:
-        with open(abs_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        result['changed'] = True
-        result['created'] = True
+    paths = [os.path.abspath(os.path.expanduser(item['path'])) for item in items]
+    if not module.check_mode:
+        make_dirs([os.path.dirname(abs_path) for abs_path in paths], writer)
 
-    elif old_content != content:
-        with open(abs_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        result['changed'] = True
-        result['updated'] = True
+    def apply_item(n):
+        item = items[n]
+        probe = (
+            item['content'] is None and item['content_b64'] is None
+            and item['delta_ops'] is None and item['checksum'] is not None
+        )
+        payload = None if probe or item['delta_ops'] is not None else Payload.from_item(item)
+        return apply_file(
+            paths[n], payload, module.check_mode, writer, item['checksum'],
+            item['delta'], item['delta_block_size'], item['delta_ops'], module._diff, store, item_attrs[n],
+            item['delta_in_place'],
+        )
+
+    try:
+        file_results = run_parallel(apply_item, len(items))
+    except PAYLOAD_ERRORS as e:
+        module.fail_json(msg=f"Invalid content_b64 payload: {e}")
+    except PermissionError as e:
+        # Например, owner/group без root
+        module.fail_json(msg=f"Permission denied: {e}")
+    except SymlinkTargetError as e:
+        module.fail_json(msg=str(e))
+
+    if store is not None and module.params['dedup_max_age'] is not None:
+        store.prune(module.params['dedup_max_age'])
+
+    # Один fsync на каталог после всех переименований
+    writer.sync_dirs()
+
+    if module.params['files'] is None:
+        result.update(file_results[0])
+        module.exit_json(**result)
+
+    for item, file_result in zip(items, file_results):
+        file_result['path'] = item['path']
+
+    if module._diff:
+        result['diff'] = [r.pop('diff') for r in file_results if 'diff' in r]
+
+    result['changed'] = any(r['changed'] for r in file_results)
+    result['created'] = any(r['created'] for r in file_results)
+    result['updated'] = any(r['updated'] for r in file_results)
+    result['files'] = file_results
+    result['summary'] = dict(
+        total=len(file_results),
+        created=sum(r['created'] for r in file_results),
+        updated=sum(r['updated'] for r in file_results),
+        attributes_changed=sum(bool(r.get('attributes_changed')) for r in file_results),
+        unchanged=sum(not r['changed'] for r in file_results),
+    )
 
     module.exit_json(**result)
 
@@ -18,11 +18,14 @@ module: yc
 short_description: Control of creating virtual machines in yandec cloud.
 version_added: "1.0.0"
 description: This is the initial level of interaction with Yandex Cloud. In this version of the module, only the creation of virtual machines in the YC cloud is available.
+requirements:
+    - yandexcloud >= 0.411, < 0.412 (O(grpc_channels) and the channel options use SDK internals checked against this version)
 options:
     folder_id:
         description:
             - Yandex Cloud Folder ID.
-        required: true
+            - Default folder for VMs that do not set their own O(vms[].folder_id).
+        required: false
         type: str
     service_account_key_file:
         description:
@@ -36,6 +39,123 @@ options:
             - Use service_account_key_file or token
         required: true
         type: str
+    max_workers:
+        description:
+            - "Maximum number of folders that are scanned and reconciled in parallel."
+            - "All workers share one authenticated SDK and its gRPC channels."
+        type: int
+        default: 8
+    grpc_keepalive_time:
+        description:
+            - "Seconds between gRPC keepalive pings, so idle channels survive long operation waits."
+            - "Keepalive is disabled when not set."
+        type: int
+    grpc_compression:
+        description:
+            - "Compression of gRPC messages."
+        type: str
+        choices: [none, gzip]
+        default: none
+    grpc_max_receive_size:
+        description:
+            - "Maximum size of a received gRPC message in MB, for big FULL-view Get and List responses."
+        type: int
+    grpc_call_timeout:
+        description:
+            - "Deadline in seconds for each API call (Get, List, Create, ...). Operation polling is not affected."
+        type: int
+    grpc_channels:
+        description:
+            - "Number of separate gRPC channels (connections) to the Compute API used by parallel folder workers."
+        type: int
+        default: 1
+    timeout:
+        description:
+            - "Time budget in seconds for the whole task."
+            - "When it runs out, pending operations are cancelled where the API allows it, VMs that were not
+              started are skipped and the task fails with lists of completed, in progress, interrupted
+              (the next operation of a VM was not started) and not started VMs."
+        type: int
+    operation_timeouts:
+        description:
+            - "Maximum wait in seconds for a single operation of each kind. Always capped by O(timeout)."
+            - "An operation that exceeds its timeout is cancelled where possible and the VM gets status V(timeout)."
+        type: dict
+        options:
+            create:
+                description: "Timeout of instance Create."
+                type: int
+            delete:
+                description: "Timeout of instance Delete (recreate)."
+                type: int
+            stop:
+                description: "Timeout of instance Stop."
+                type: int
+            update:
+                description: "Timeout of instance Update."
+                type: int
+            start:
+                description: "Timeout of instance Start."
+                type: int
+    ensure_running:
+        description:
+            - "Start managed VMs that are STOPPED, for example preemptible VMs stopped by the cloud."
+            - "The status is taken from the folder scan the module already does. All stopped VMs of a folder
+              are started at the same time and waited for together, after the other changes are applied."
+            - "A VM that is still STOPPING is not started."
+        type: bool
+        default: false
+    wait_for:
+        description:
+            - "After changes are applied, wait until the VMs are ready and return their addresses."
+            - "V(running) waits for instance status RUNNING, V(ssh) additionally waits until O(wait_for_port)
+              accepts TCP connections on the NAT address (or the internal one when there is no NAT)."
+            - "All VMs are polled concurrently, with one List call per folder per poll round."
+            - "Each VM is waited for as soon as its own operations finish, so slow VMs do not delay the others.
+              RV(instances[].ready_time) is measured from the start of the VM's operations."
+        type: str
+        choices: [none, running, ssh]
+        default: none
+    wait_for_port:
+        description:
+            - "TCP port probed by O(wait_for=ssh)."
+        type: int
+        default: 22
+    wait_for_timeout:
+        description:
+            - "Maximum wait for readiness of each VM in seconds, counted from the end of its operations.
+              Always capped by O(timeout)."
+        type: int
+        default: 300
+    worker:
+        description:
+            - "Run the reconcile in a long-lived local worker process instead of this task's process."
+            - "The worker listens on a Unix socket, is started on demand and keeps the SDK, its gRPC channels,
+              the IAM token and the folder scans warm between tasks, so loops over this module skip the setup cost."
+        type: bool
+        default: false
+    worker_socket:
+        description:
+            - "Path of the worker Unix socket."
+            - "Defaults to C(yc-worker-<hash>.sock) in C($XDG_RUNTIME_DIR/yc-worker), or in C(~/.ansible/yc-worker)
+              if C(XDG_RUNTIME_DIR) is not set. The hash is taken from the module code, so after a collection
+              upgrade a new worker is started instead of reusing one that runs the old code.
+              A custom path is used as is, so it should differ between collection versions."
+            - "The directory of the socket must be owned by the current user and not accessible to group or others:
+              the task parameters, including the token, are sent over this socket.
+              The worker at the other end must run as the same user."
+        type: str
+    worker_idle_timeout:
+        description:
+            - "Seconds without requests after which the worker exits."
+        type: int
+        default: 300
+    worker_cache_ttl:
+        description:
+            - "Seconds the worker may reuse a folder scan. A folder is rescanned after any change applied to it."
+            - "Use V(0) to scan on every task."
+        type: int
+        default: 30
     vms:
         description:
             - "List of virtual machines to create or manage."
@@ -47,6 +167,10 @@ options:
                     - "The name of the virtual machine."
                 type: str
                 required: true
+            folder_id:
+                description:
+                    - "Folder ID of this VM. Overrides the top-level O(folder_id)."
+                type: str
             zone:
                 description:
                     - "The zone where the VM will be created."
@@ -113,7 +237,8 @@ options:
                                 required: true
             network_interface_specs:
                 description:
-                    - "Network interfaces of the VM."
+                    - "The network interface of a VM with a single interface (index 0)."
+                    - "Mutually exclusive with O(vms[].network_interfaces)."
                 type: dict
                 options:
                     subnet_id:
@@ -128,9 +253,77 @@ options:
                         options:
                             nat:
                                 description:
-                                    - "Enable NAT"
+                                    - "Enable NAT. Changed on a running VM."
                                 type: bool
                                 default: true
+            network_interfaces:
+                description:
+                    - "Network interfaces of the VM, compared with the existing ones by index."
+                    - "Adding or removing an interface or changing its subnet needs the VM stopped,
+                      so it requires O(vms[].force_restart). NAT is added or removed on a running VM."
+                type: list
+                elements: dict
+                options:
+                    index:
+                        description:
+                            - "Interface index. Defaults to the position in the list."
+                        type: str
+                    subnet_id:
+                        description:
+                            - "Subnet ID."
+                        type: str
+                        required: true
+                    primary_v4_address_spec:
+                        description:
+                            - "Primary IPv4 address settings."
+                        type: dict
+                        options:
+                            nat:
+                                description:
+                                    - "Enable NAT."
+                                type: bool
+                                default: true
+            secondary_disk_specs:
+                description:
+                    - "Secondary disks of the VM, compared with the attached ones by device name."
+                    - "Missing disks are created and attached (or attached by O(vms[].secondary_disk_specs[].disk_id)),
+                      disks not in the list are detached but not deleted, growing O(vms[].secondary_disk_specs[].disk_spec.size)
+                      resizes the disk. Changing the type or the image of a disk requires O(vms[].force_recreate)."
+                    - "Disk operations of all VMs are run concurrently. Omit the option to leave the disks unmanaged."
+                type: list
+                elements: dict
+                options:
+                    device_name:
+                        description:
+                            - "Device name of the disk inside the VM (C(/dev/disk/by-id/virtio-<device_name>))."
+                        type: str
+                        required: true
+                    auto_delete:
+                        description:
+                            - "Delete the disk together with the VM. Only used when the disk is attached."
+                        type: bool
+                        default: false
+                    disk_id:
+                        description:
+                            - "Attach this existing disk instead of creating one from O(vms[].secondary_disk_specs[].disk_spec)."
+                        type: str
+                    disk_spec:
+                        description:
+                            - "Parameters of the disk to create."
+                        type: dict
+                        options:
+                            type_id:
+                                description:
+                                    - "Disk type, e.g., network-hdd or network-ssd."
+                                type: str
+                            size:
+                                description:
+                                    - "Disk size in GB. Disks can only grow."
+                                type: int
+                            image_id:
+                                description:
+                                    - "Image ID for the disk."
+                                type: str
             scheduling_policy:
                 description:
                     - "VM scheduling policy."
@@ -214,29 +407,177 @@ EXAMPLES = r'''
                 metadata:
                   ssh-keys: "ubuntu:ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAACAQD..."
 
+- name: Managing virtual machines in several folders at once
+  hosts: localhost
+  tasks:
+    - dimosspb-devopscourse.training.yc:
+        folder_id: "b1gg....5qo1tt"
+        service_key_file: "/home/user/.secret/ya-sa.json"
+        max_workers: 12
+        vms:
+          - name: "web1"
+            zone: "ru-central1-a"
+            resources_spec:
+              cores: 2
+              memory: 2
+            boot_disk_spec:
+              disk_spec:
+                size: 10
+                image_id: "fd80g4....8q9r0s1"
+            network_interface_specs:
+              subnet_id: "subnet-12345678"
+          - name: "db1"
+            folder_id: "b1gq....k2m3n4"
+            zone: "ru-central1-b"
+            resources_spec:
+              cores: 4
+              memory: 8
+            boot_disk_spec:
+              disk_spec:
+                size: 50
+                image_id: "fd80g4....8q9r0s1"
+            network_interface_specs:
+              subnet_id: "subnet-87654321"
+
+- name: Create VMs and add them to the inventory as soon as SSH answers
+  hosts: localhost
+  tasks:
+    - dimosspb-devopscourse.training.yc:
+        folder_id: "b1gg....5qo1tt"
+        service_key_file: "/home/user/.secret/ya-sa.json"
+        wait_for: ssh
+        wait_for_timeout: 600
+        vms: "{{ yc_vms }}"
+      register: yc_result
+
+    - ansible.builtin.add_host:
+        name: "{{ item.name }}"
+        ansible_host: "{{ item.external_ip }}"
+      loop: "{{ yc_result.instances | selectattr('ready') }}"
+
+- name: Loop over VMs through the warm local worker
+  hosts: localhost
+  tasks:
+    - dimosspb-devopscourse.training.yc:
+        folder_id: "b1gg....5qo1tt"
+        service_key_file: "/home/user/.secret/ya-sa.json"
+        worker: true
+        worker_idle_timeout: 600
+        vms:
+          - "{{ item }}"
+      loop: "{{ yc_vms }}"
+
+- name: VM with two network interfaces and a data disk
+  hosts: localhost
+  tasks:
+    - dimosspb-devopscourse.training.yc:
+        folder_id: "b1gg....5qo1tt"
+        service_key_file: "/home/user/.secret/ya-sa.json"
+        vms:
+          - name: "db1"
+            zone: "ru-central1-a"
+            resources_spec:
+              cores: 4
+              memory: 8
+            boot_disk_spec:
+              disk_spec:
+                size: 20
+                image_id: "fd80g4....8q9r0s1"
+            network_interfaces:
+              - subnet_id: "subnet-12345678"
+              - subnet_id: "subnet-87654321"
+                primary_v4_address_spec:
+                  nat: false
+            secondary_disk_specs:
+              - device_name: data
+                disk_spec:
+                  type_id: network-ssd
+                  size: 100
+
+- name: Bring back preemptible VMs stopped by the cloud
+  hosts: localhost
+  tasks:
+    - dimosspb-devopscourse.training.yc:
+        folder_id: "b1gg....5qo1tt"
+        service_key_file: "/home/user/.secret/ya-sa.json"
+        ensure_running: true
+        wait_for: running
+        vms: "{{ yc_vms }}"
 '''
 
 RETURN = r'''
 changed:
-    description: File was created or its content was changed.
+    description: At least one VM was created, recreated, updated or started.
     type: bool
     returned: always
     sample: true
 
-created:
-    description: Indicates if the file was created.
-    type: bool
+completed:
+    description: Names of VMs whose reconcile finished (successfully or with an error).
+    type: list
+    elements: str
     returned: always
-    sample: true
 
-updated:
-    description: Indicates if the file exist and its content was updated.
-    type: bool
+in_progress:
+    description: Names of VMs whose operation did not finish in time and was cancelled where possible.
+    type: list
+    elements: str
     returned: always
-    sample: true
+
+interrupted:
+    description:
+        - Names of VMs whose remaining operations were not started because the O(timeout) budget ran out,
+          after the earlier ones finished (for example, a recreate whose Delete finished but whose Create was not issued).
+        - Nothing is running for them, run the task again to complete them.
+    type: list
+    elements: str
+    returned: always
+
+not_started:
+    description:
+        - Names of VMs that were skipped because the O(timeout) budget ran out,
+          including VMs of folders whose scan did not finish within the budget.
+    type: list
+    elements: str
+    returned: always
+
+not_ready:
+    description: Names of VMs that did not become ready within O(wait_for_timeout).
+    type: list
+    elements: str
+    returned: when O(wait_for) is not V(none)
+
+instances:
+    description: Per-VM results merged from all folders, in the order of O(vms).
+    type: list
+    elements: dict
+    returned: always
+    sample:
+        - name: vm1
+          folder_id: b1gg....5qo1tt
+          changed: true
+          status: created
+          ready: true
+          ready_time: 41.3
+          instance_status: RUNNING
+          id: fhm1....k9
+          fqdn: vm1.ru-central1.internal
+          internal_ip: 10.128.0.12
+          external_ip: 51.250.1.2
 '''
 
+import collections
+import fcntl
+import hashlib
 import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
 import grpc
 import yandexcloud
 from google.protobuf.field_mask_pb2 import FieldMask
@@ -244,13 +585,22 @@ from yandexcloud import SDK, RetryPolicy, ThrottlingMode  # type: ignore
 from yandex.cloud.compute.v1.instance_service_pb2_grpc import InstanceServiceStub
 from yandex.cloud.compute.v1.instance_service_pb2 import GetInstanceRequest, InstanceView
 from yandex.cloud.compute.v1.instance_pb2 import IPV4, Instance, SchedulingPolicy
-from yandex.cloud.compute.v1.disk_service_pb2 import GetDiskRequest
+from yandex.cloud.compute.v1.disk_service_pb2 import GetDiskRequest, UpdateDiskRequest
 from yandex.cloud.compute.v1.disk_service_pb2_grpc import DiskServiceStub
+from yandex.cloud.operation.operation_service_pb2 import CancelOperationRequest, GetOperationRequest
+from yandex.cloud.operation.operation_service_pb2_grpc import OperationServiceStub
 from yandex.cloud.compute.v1.instance_service_pb2 import (
     CreateInstanceMetadata,
     DeleteInstanceMetadata,
     StopInstanceMetadata,
     StartInstanceMetadata,
+    AttachInstanceDiskRequest,
+    DetachInstanceDiskRequest,
+    AttachInstanceNetworkInterfaceRequest,
+    DetachInstanceNetworkInterfaceRequest,
+    UpdateInstanceNetworkInterfaceRequest,
+    AddInstanceOneToOneNatRequest,
+    RemoveInstanceOneToOneNatRequest,
     ListInstancesRequest,
     UpdateInstanceRequest,
     StartInstanceRequest,
@@ -264,6 +614,7 @@ from yandex.cloud.compute.v1.instance_service_pb2 import (
     AttachedDiskSpec,
 )
 from ansible.module_utils.basic import AnsibleModule
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any
 from enum import Enum
 
@@ -273,11 +624,20 @@ class VMAction(str, Enum):
     RESTART = "restart"
     INPLACE = "inplace"
 
+class YCModuleError(Exception):
+    #
+    # Ошибка планирования/применения, которую run_module превращает в fail_json
+    #
+    def __init__(self, msg, **kwargs):
+        super().__init__(msg)
+        self.msg = msg
+        self.kwargs = kwargs
+
 FIELDS_SPEC = {
     "folder_id": {
         "action": VMAction.RECREATE,
         "type": "str",
-        "required": True,
+        "default": None,
     },
     "service_key_file": {
         "action": VMAction.INPLACE,
@@ -289,6 +649,107 @@ FIELDS_SPEC = {
         "type": "str",
         "default": None,
     },
+    "max_workers": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": 8,
+    },
+    "grpc_keepalive_time": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": None,
+    },
+    "grpc_compression": {
+        "action": VMAction.INPLACE,
+        "type": "str",
+        "choices": ["none", "gzip"],
+        "default": "none",
+    },
+    "grpc_max_receive_size": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": None,
+    },
+    "grpc_call_timeout": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": None,
+    },
+    "grpc_channels": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": 1,
+    },
+    "timeout": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": None,
+    },
+    "operation_timeouts": {
+        "type": "dict",
+        "default": None,
+        "create": {
+            "action": VMAction.INPLACE,
+            "type": "int",
+        },
+        "delete": {
+            "action": VMAction.INPLACE,
+            "type": "int",
+        },
+        "stop": {
+            "action": VMAction.INPLACE,
+            "type": "int",
+        },
+        "update": {
+            "action": VMAction.INPLACE,
+            "type": "int",
+        },
+        "start": {
+            "action": VMAction.INPLACE,
+            "type": "int",
+        },
+    },
+    "ensure_running": {
+        "action": VMAction.INPLACE,
+        "type": "bool",
+        "default": False,
+    },
+    "wait_for": {
+        "action": VMAction.INPLACE,
+        "type": "str",
+        "choices": ["none", "running", "ssh"],
+        "default": "none",
+    },
+    "wait_for_port": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": 22,
+    },
+    "wait_for_timeout": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": 300,
+    },
+    "worker": {
+        "action": VMAction.INPLACE,
+        "type": "bool",
+        "default": False,
+    },
+    "worker_socket": {
+        "action": VMAction.INPLACE,
+        "type": "str",
+        "default": None,
+    },
+    "worker_idle_timeout": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": 300,
+    },
+    "worker_cache_ttl": {
+        "action": VMAction.INPLACE,
+        "type": "int",
+        "default": 30,
+    },
     "vms": [
         {
             "type": "dict",
@@ -297,6 +758,11 @@ FIELDS_SPEC = {
                 "type": "str",
                 "required": True,
             },
+            "folder_id": {
+                "action": VMAction.RECREATE,
+                "type": "str",
+                "default": None,
+            },
             "zone": {
                 "action": VMAction.RECREATE,
                 "type": "str",
@@ -365,12 +831,68 @@ FIELDS_SPEC = {
                 "primary_v4_address_spec": {
                     "type": "dict",
                     "nat": {
-                        "action": VMAction.RESTART,
+                        "action": VMAction.INPLACE,
                         "type": "bool",
                         "default": True,
                     },
                 },
             },
+            "network_interfaces": [
+                {
+                    "type": "dict",
+                    "index": {
+                        "action": VMAction.RESTART,
+                        "type": "str",
+                    },
+                    "subnet_id": {
+                        "action": VMAction.RESTART,
+                        "type": "str",
+                        "required": True,
+                    },
+                    "primary_v4_address_spec": {
+                        "type": "dict",
+                        "nat": {
+                            "action": VMAction.INPLACE,
+                            "type": "bool",
+                            "default": True,
+                        },
+                    },
+                },
+            ],
+            "secondary_disk_specs": [
+                {
+                    "type": "dict",
+                    "device_name": {
+                        "action": VMAction.INPLACE,
+                        "type": "str",
+                        "required": True,
+                    },
+                    "auto_delete": {
+                        "action": VMAction.INPLACE,
+                        "type": "bool",
+                        "default": False,
+                    },
+                    "disk_id": {
+                        "action": VMAction.INPLACE,
+                        "type": "str",
+                    },
+                    "disk_spec": {
+                        "type": "dict",
+                        "type_id": {
+                            "action": VMAction.RECREATE,
+                            "type": "str",
+                        },
+                        "size": {
+                            "action": VMAction.INPLACE,
+                            "type": "int",
+                        },
+                        "image_id": {
+                            "action": VMAction.RECREATE,
+                            "type": "str",
+                        },
+                    },
+                },
+            ],
             "scheduling_policy": {
                 "type": "dict",
                 "preemptible": {
@@ -394,6 +916,88 @@ FIELDS_SPEC = {
     ],
 }
 
+class OperationTimeout(Exception):
+    pass
+
+class OperationNotStarted(OperationTimeout):
+    # Бюджет задачи кончился до запуска операции: ничего не выполняется, отменять нечего
+    pass
+
+class Deadline:
+    #
+    # Общий бюджет времени задачи и таймауты отдельных операций
+    #
+    def __init__(self, timeout=None, operation_timeouts=None):
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.operation_timeouts = {k: v for k, v in (operation_timeouts or {}).items() if v}
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        return self.deadline is not None and self.remaining() == 0
+
+    def operation_timeout(self, action):
+        limits = [t for t in (self.operation_timeouts.get(action), self.remaining()) if t is not None]
+        return min(limits) if limits else None
+
+def cancel_operation(sdk, operation_id):
+    # Не все операции Compute можно отменить - тогда просто перестаем ждать
+    try:
+        sdk.client(OperationServiceStub).Cancel(CancelOperationRequest(operation_id=operation_id))
+    except grpc.RpcError:
+        pass
+
+def run_operation(sdk, deadline, action, start, meta_type=None):
+    #
+    # Запускает операцию start() и ждет ее не дольше таймаута action и остатка бюджета
+    #
+    if deadline.expired():
+        raise OperationNotStarted(f"{action}: not started, task timeout exceeded")
+
+    operation = start()
+    timeout = deadline.operation_timeout(action)
+    if timeout is None:
+        return sdk.wait_operation_and_get_result(operation, meta_type=meta_type)
+
+    # Опрашиваем сами: у каждого Get свой deadline не дальше конца таймаута,
+    # иначе зависший вызов держал бы задачу сверх бюджета
+    operation_service = sdk.client(OperationServiceStub)
+    until = time.monotonic() + timeout
+    result = operation
+    while not result.done:
+        left = until - time.monotonic()
+        if left <= 0:
+            break
+        time.sleep(min(1, left))
+        left = until - time.monotonic()
+        if left <= 0:
+            break
+        try:
+            result = operation_service.Get(GetOperationRequest(operation_id=operation.id), timeout=left)
+        except grpc.RpcError as e:
+            if e.code() not in (grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.UNAVAILABLE):
+                raise
+
+    if not result.done:
+        cancel_operation(sdk, operation.id)
+        raise OperationTimeout(f"{action}: operation {operation.id} did not finish in {timeout:.1f}s, cancelled")
+    if result.error and result.error.code:
+        raise RuntimeError(f"{action}: operation {operation.id} failed: {result.error.message}")
+    return result
+
+def error_status(error):
+    #
+    # interrupted - предыдущие шаги VM (например, Delete при пересоздании) выполнены,
+    # а следующие уже не запускались; timeout - операция была запущена и не успела
+    #
+    if isinstance(error, OperationNotStarted):
+        return "interrupted"
+    return "timeout" if isinstance(error, OperationTimeout) else "error"
+
 def build_arguments(fields_spec):
     spec = {}
 
@@ -437,6 +1041,8 @@ def build_arguments(fields_spec):
                 field_spec["required"] = props["required"]
             if "default" in props:
                 field_spec["default"] = props["default"]
+            if "choices" in props:
+                field_spec["choices"] = props["choices"]
             spec[field] = field_spec
             continue
 
@@ -457,6 +1063,10 @@ def build_vm_diff(desired_vm: Dict, sdk, current_instance: Instance | None, fiel
         "changed": False
     }
 
+    # Ошибки в описании NIC и дисков - до каких-либо изменений
+    desired_nics(desired_vm)
+    desired_disks(desired_vm)
+
     if current_instance is None:
         diff["changes"].append("VM does not exist, needs creation")
         diff["actions"][VMAction.CREATE.value] = True
@@ -469,6 +1079,8 @@ def build_vm_diff(desired_vm: Dict, sdk, current_instance: Instance | None, fiel
     # Базовые поля
     if hasattr(current_instance, 'name'):
         current_vm["name"] = current_instance.name
+    if hasattr(current_instance, 'folder_id'):
+        current_vm["folder_id"] = current_instance.folder_id
     if hasattr(current_instance, 'zone_id'):
         current_vm["zone"] = current_instance.zone_id
     if hasattr(current_instance, 'platform_id'):
@@ -497,17 +1109,7 @@ def build_vm_diff(desired_vm: Dict, sdk, current_instance: Instance | None, fiel
             current_vm["boot_disk_spec"] = {"disk_spec": disk_info}
             # print("Disk info:", disk_info)
 
-    # Network interfaces
-    if hasattr(current_instance, 'network_interfaces') and current_instance.network_interfaces:
-        nic = current_instance.network_interfaces[0]
-        nic_spec = {
-            "subnet_id": nic.subnet_id,
-            "primary_v4_address_spec": {
-                "nat": bool(nic.primary_v4_address.one_to_one_nat)
-            }
-
-        }
-        current_vm["network_interface_specs"] = nic_spec
+    # Сетевые интерфейсы и вторичные диски сравниваются по index / device_name в diff_devices
 
     # Scheduling policy
     if hasattr(current_instance, 'scheduling_policy'):
@@ -583,7 +1185,7 @@ def build_vm_diff(desired_vm: Dict, sdk, current_instance: Instance | None, fiel
 
     # Сравниваем поля согласно FIELDS_SPEC
     for field, field_spec in fields_spec.items():
-        if field in ["type", "required", "default", "action", "force_restart", "force_recreate"]:
+        if field in ["type", "required", "default", "action", "force_restart", "force_recreate"] or field in DEVICE_FIELDS:
             continue
 
         field_path = field
@@ -606,18 +1208,214 @@ def build_vm_diff(desired_vm: Dict, sdk, current_instance: Instance | None, fiel
             diff["changes"].append(f"{field_path}: {current_vm[field]} -> None")
             diff["actions"][action.value] = True
 
+    diff_devices(desired_vm, sdk, current_instance, diff)
+
     diff["changed"] = len(diff["changes"]) > 0
     return diff
 
-def create_instance(sdk, instance_service , vm_spec, instance: Instance | None):
+# Поля VM, которые сравниваются не FIELDS_SPEC, а diff_devices
+DEVICE_FIELDS = ("network_interface_specs", "network_interfaces", "secondary_disk_specs")
+# Операции с NIC, для которых VM должна быть остановлена
+NIC_STOP_OPS = ("attach_nic", "detach_nic", "update_nic")
+
+def desired_nics(vm):
+    #
+    # {index: {"subnet_id", "nat"}} или None, если интерфейсы VM не заданы.
+    # network_interface_specs - это один интерфейс с index 0
+    #
+    if vm.get("network_interfaces") is not None and vm.get("network_interface_specs"):
+        raise YCModuleError(f"VM {vm['name']}: network_interfaces and network_interface_specs are mutually exclusive")
+    if vm.get("network_interfaces") is not None:
+        nics = vm["network_interfaces"]
+    elif vm.get("network_interface_specs"):
+        nics = [vm["network_interface_specs"]]
+    else:
+        return None
+
+    result = {}
+    for n, nic in enumerate(nics):
+        nat = (nic.get("primary_v4_address_spec") or {}).get("nat")
+        result[nic.get("index") or str(n)] = {
+            "subnet_id": nic.get("subnet_id"),
+            "nat": True if nat is None else nat,
+        }
+    return result
+
+def desired_disks(vm):
+    # {device_name: spec} или None, если вторичными дисками модуль не управляет
+    if vm.get("secondary_disk_specs") is None:
+        return None
+    disks = {}
+    for disk in vm["secondary_disk_specs"]:
+        if not disk.get("disk_id") and not (disk.get("disk_spec") or {}).get("size"):
+            raise YCModuleError(f"VM {vm['name']}: disk {disk['device_name']} needs disk_id or disk_spec.size")
+        disks[disk["device_name"]] = disk
+    return disks
+
+def diff_devices(desired_vm, sdk, instance, diff):
+    #
+    # NIC сравниваются по index, вторичные диски - по device_name. Кроме строк в changes
+    # в diff складываются операции: nic_ops выполняет update_instance (в окне остановки VM),
+    # disk_ops - apply_folder, одновременно для всех VM каталога
+    #
+    nic_ops = []
+    disk_ops = []
+
+    nics = desired_nics(desired_vm)
+    if nics is not None:
+        current = {
+            nic.index: {
+                "subnet_id": nic.subnet_id,
+                "nat": nic.primary_v4_address.HasField("one_to_one_nat"),
+                "address": nic.primary_v4_address.address,
+            }
+            for nic in instance.network_interfaces
+        }
+        for index, nic in current.items():
+            if index not in nics:
+                diff["changes"].append(f"network_interfaces[{index}]: {nic['subnet_id']} -> None")
+                diff["actions"][VMAction.RESTART.value] = True
+                nic_ops.append(("detach_nic", index))
+        for index, nic in nics.items():
+            if index not in current:
+                diff["changes"].append(f"network_interfaces[{index}]: None -> {nic['subnet_id']}")
+                diff["actions"][VMAction.RESTART.value] = True
+                nic_ops.append(("attach_nic", index, nic))
+                continue
+            subnet_changed = nic["subnet_id"] != current[index]["subnet_id"]
+            if subnet_changed:
+                diff["changes"].append(
+                    f"network_interfaces[{index}].subnet_id: {current[index]['subnet_id']} -> {nic['subnet_id']}"
+                )
+                diff["actions"][VMAction.RESTART.value] = True
+                nic_ops.append(("update_nic", index, nic))
+            if nic["nat"] != current[index]["nat"]:
+                diff["changes"].append(f"network_interfaces[{index}].nat: {current[index]['nat']} -> {nic['nat']}")
+                diff["actions"][VMAction.INPLACE.value] = True
+                # В новой подсети у NIC будет другой адрес: NAT задает сам update_nic
+                if not subnet_changed:
+                    nic_ops.append(("add_nat" if nic["nat"] else "remove_nat", index, current[index]["address"]))
+
+    disks = desired_disks(desired_vm)
+    if disks is not None:
+        current = {disk.device_name: disk for disk in instance.secondary_disks}
+        for name, attached in current.items():
+            if name not in disks or (disks[name].get("disk_id") and disks[name]["disk_id"] != attached.disk_id):
+                diff["changes"].append(f"secondary_disk_specs[{name}]: {attached.disk_id} -> None")
+                diff["actions"][VMAction.INPLACE.value] = True
+                disk_ops.append(("detach", name))
+        for name, disk in disks.items():
+            attached = current.get(name)
+            if attached is None or (disk.get("disk_id") and disk["disk_id"] != attached.disk_id):
+                diff["changes"].append(f"secondary_disk_specs[{name}]: None -> {disk.get('disk_id') or disk['disk_spec']}")
+                diff["actions"][VMAction.INPLACE.value] = True
+                disk_ops.append(("attach", disk))
+                continue
+            wanted = disk.get("disk_spec") or {}
+            if disk.get("disk_id") or not wanted:
+                continue
+            current_disk = sdk.client(DiskServiceStub).Get(GetDiskRequest(disk_id=attached.disk_id))
+            for field, current_value in (("type_id", current_disk.type_id), ("image_id", current_disk.source_image_id)):
+                if wanted.get(field) and wanted[field] != current_value:
+                    diff["changes"].append(f"secondary_disk_specs[{name}].disk_spec.{field}: {current_value} -> {wanted[field]}")
+                    diff["actions"][VMAction.RECREATE.value] = True
+            current_size = current_disk.size // (1024**3)
+            if wanted.get("size") and wanted["size"] != current_size:
+                diff["changes"].append(f"secondary_disk_specs[{name}].disk_spec.size: {current_size} -> {wanted['size']}")
+                # Диск можно только увеличить, уменьшить - только пересоздав VM
+                if wanted["size"] < current_size:
+                    diff["actions"][VMAction.RECREATE.value] = True
+                else:
+                    diff["actions"][VMAction.INPLACE.value] = True
+                    disk_ops.append(("resize", attached.disk_id, wanted["size"]))
+
+    diff["nic_ops"] = nic_ops
+    diff["disk_ops"] = disk_ops
+
+def attached_disk_spec(disk):
+    if disk.get("disk_id"):
+        return AttachedDiskSpec(
+            device_name=disk["device_name"],
+            auto_delete=bool(disk.get("auto_delete")),
+            disk_id=disk["disk_id"],
+        )
+    disk_spec = disk.get("disk_spec") or {}
+    return AttachedDiskSpec(
+        device_name=disk["device_name"],
+        auto_delete=bool(disk.get("auto_delete")),
+        disk_spec=AttachedDiskSpec.DiskSpec(
+            type_id=disk_spec.get("type_id"),
+            size=disk_spec["size"] * 1024**3,
+            image_id=disk_spec.get("image_id"),
+        ),
+    )
+
+def primary_address_spec(nic):
+    return PrimaryAddressSpec(one_to_one_nat_spec=OneToOneNatSpec(ip_version=IPV4) if nic["nat"] else None)
+
+def run_nic_op(sdk, instance_service, instance, op, deadline):
+    kind, index = op[0], op[1]
+    if kind == "attach_nic":
+        start = lambda: instance_service.AttachNetworkInterface(AttachInstanceNetworkInterfaceRequest(
+            instance_id=instance.id, network_interface_index=index,
+            subnet_id=op[2]["subnet_id"], primary_v4_address_spec=primary_address_spec(op[2]),
+        ))
+    elif kind == "detach_nic":
+        start = lambda: instance_service.DetachNetworkInterface(DetachInstanceNetworkInterfaceRequest(
+            instance_id=instance.id, network_interface_index=index,
+        ))
+    elif kind == "update_nic":
+        start = lambda: instance_service.UpdateNetworkInterface(UpdateInstanceNetworkInterfaceRequest(
+            instance_id=instance.id, network_interface_index=index,
+            update_mask=FieldMask(paths=["subnet_id", "primary_v4_address_spec"]), subnet_id=op[2]["subnet_id"],
+            primary_v4_address_spec=primary_address_spec(op[2]),
+        ))
+    elif kind == "add_nat":
+        start = lambda: instance_service.AddOneToOneNat(AddInstanceOneToOneNatRequest(
+            instance_id=instance.id, network_interface_index=index, internal_address=op[2],
+            one_to_one_nat_spec=OneToOneNatSpec(ip_version=IPV4),
+        ))
+    else:
+        start = lambda: instance_service.RemoveOneToOneNat(RemoveInstanceOneToOneNatRequest(
+            instance_id=instance.id, network_interface_index=index, internal_address=op[2],
+        ))
+    run_operation(sdk, deadline, "update", start)
+
+def run_disk_ops(sdk, instance_service, instance, disk_ops, deadline):
+    #
+    # Операции одной VM идут по очереди (у инстанса одна операция за раз),
+    # разные VM обрабатываются параллельно в apply_folder
+    #
+    try:
+        for op in disk_ops:
+            if op[0] == "detach":
+                run_operation(sdk, deadline, "update", lambda: instance_service.DetachDisk(
+                    DetachInstanceDiskRequest(instance_id=instance.id, device_name=op[1])
+                ))
+            elif op[0] == "attach":
+                run_operation(sdk, deadline, "update", lambda: instance_service.AttachDisk(
+                    AttachInstanceDiskRequest(instance_id=instance.id, attached_disk_spec=attached_disk_spec(op[1]))
+                ))
+            else:
+                run_operation(sdk, deadline, "update", lambda: sdk.client(DiskServiceStub).Update(UpdateDiskRequest(
+                    disk_id=op[1], update_mask=FieldMask(paths=["size"]), size=op[2] * 1024**3,
+                )))
+    except Exception as e:
+        return e
+    return None
+
+def create_instance(sdk, instance_service , vm_spec, instance: Instance | None, deadline: Deadline):
     #
     # Функция удалит instance если он определен и создаст новый
     # Вернет None или ошибку
     #
     if instance:
-        del_op = instance_service.Delete(DeleteInstanceRequest(instance_id=instance.id))
         try:
-            sdk.wait_operation_and_get_result(del_op, meta_type=DeleteInstanceMetadata)
+            run_operation(
+                sdk, deadline, "delete",
+                lambda: instance_service.Delete(DeleteInstanceRequest(instance_id=instance.id)),
+                meta_type=DeleteInstanceMetadata,
+            )
         except Exception as e:
             return e
 
@@ -625,8 +1423,7 @@ def create_instance(sdk, instance_service , vm_spec, instance: Instance | None):
     t_resources_spec = vm_spec.get("resources_spec", {})
     t_boot_disk_spec = vm_spec.get("boot_disk_spec", {})
     t_disk_spec = t_boot_disk_spec.get("disk_spec", {})
-    t_network_interface_specs = vm_spec.get("network_interface_specs", {})
-    t_primary_v4_address_spec = t_network_interface_specs.get("primary_v4_address_spec", {})
+    t_nics = desired_nics(vm_spec) or {}
     t_metadata = vm_spec.get("metadata", {})
     t_scheduling_policy = vm_spec.get("scheduling_policy", {})
 
@@ -637,52 +1434,59 @@ def create_instance(sdk, instance_service , vm_spec, instance: Instance | None):
     # image = image_service.Get(GetImageRequest(image_id="fd80g4m9n1o7p8q9r0s1"))
 
 
-    create_op = instance_service.Create(
-
-        CreateInstanceRequest(
-            folder_id=vm_spec.get("folder_id"),
-            name=vm_spec.get("name"),
-            zone_id=vm_spec.get("zone"),
-            platform_id=vm_spec.get("platform_id"),
-
-            resources_spec=ResourcesSpec(
-                cores=t_resources_spec.get("cores"),
-                memory=t_resources_spec.get("memory")* 1024**3,
-                core_fraction=t_resources_spec.get("core_fraction"),
+    create_request = CreateInstanceRequest(
+        folder_id=vm_spec.get("folder_id"),
+        name=vm_spec.get("name"),
+        zone_id=vm_spec.get("zone"),
+        platform_id=vm_spec.get("platform_id"),
+
+        resources_spec=ResourcesSpec(
+            cores=t_resources_spec.get("cores"),
+            memory=t_resources_spec.get("memory")* 1024**3,
+            core_fraction=t_resources_spec.get("core_fraction"),
+        ),
+        boot_disk_spec=AttachedDiskSpec(
+            auto_delete=True,
+            disk_spec=AttachedDiskSpec.DiskSpec(
+                type_id=t_disk_spec.get("type_id"),
+                size=t_disk_spec.get("size") * 1024**3,
+                image_id=t_disk_spec.get("image_id"),
             ),
-            boot_disk_spec=AttachedDiskSpec(
-                auto_delete=True,
-                disk_spec=AttachedDiskSpec.DiskSpec(
-                    type_id=t_disk_spec.get("type_id"),
-                    size=t_disk_spec.get("size") * 1024**3,
-                    image_id=t_disk_spec.get("image_id"),
-                ),
-            ),
-            network_interface_specs=[
-                NetworkInterfaceSpec(
-                    subnet_id=t_network_interface_specs.get("subnet_id"),
-                    primary_v4_address_spec=PrimaryAddressSpec(
-                        one_to_one_nat_spec=OneToOneNatSpec(
-                            ip_version=IPV4,
-                        ) if t_primary_v4_address_spec.get("nat", True) else None
-                    ),
-                ),
-            ],
-            metadata={
-                "ssh-keys": f'{t_metadata.get("ssh-keys")}',
-            },
-            scheduling_policy=SchedulingPolicy(
-                preemptible = t_scheduling_policy.get("preemptible", True),
+        ),
+        secondary_disk_specs=[attached_disk_spec(disk) for disk in vm_spec.get("secondary_disk_specs") or []],
+        network_interface_specs=[
+            NetworkInterfaceSpec(
+                index=index,
+                subnet_id=nic["subnet_id"],
+                primary_v4_address_spec=primary_address_spec(nic),
             )
+            for index, nic in t_nics.items()
+        ],
+        metadata={
+            "ssh-keys": f'{t_metadata.get("ssh-keys")}',
+        },
+        scheduling_policy=SchedulingPolicy(
+            preemptible = t_scheduling_policy.get("preemptible", True),
         )
     )
     try:
-        sdk.wait_operation_and_get_result(create_op, meta_type=CreateInstanceMetadata)
+        run_operation(
+            sdk, deadline, "create",
+            lambda: instance_service.Create(create_request),
+            meta_type=CreateInstanceMetadata,
+        )
     except Exception as e:
         return e
     return None
 
-def update_instance(sdk, instance_service, vm_spec, instance, vm_diff):
+def needs_stop(vm_diff):
+    # Смена ресурсов, подключение, отключение и смена подсети NIC - только на остановленной VM
+    return (
+        any(change.startswith("resources_spec.") for change in vm_diff.get("changes", []))
+        or any(op[0] in NIC_STOP_OPS for op in vm_diff.get("nic_ops") or [])
+    )
+
+def update_instance(sdk, instance_service, vm_spec, instance, vm_diff, deadline: Deadline):
     update_mask = FieldMask()
     request_fields = {}
 
@@ -710,38 +1514,58 @@ def update_instance(sdk, instance_service, vm_spec, instance, vm_diff):
             preemptible=scheduling.get("preemptible", False)
         )
 
-    if not update_mask.paths:
+    nic_ops = vm_diff.get("nic_ops") or []
+    #
+    # Остановленную VM останавливать не нужно (Stop на ней завершится ошибкой),
+    # а запускаем ее после изменений, только если запуск запрошен (ensure_running)
+    #
+    was_stopped = instance.status == Instance.Status.STOPPED
+    stop = needs_stop(vm_diff) and not was_stopped
+    start = needs_stop(vm_diff) and (not was_stopped or vm_diff.get("start", False))
+
+    if not update_mask.paths and not nic_ops:
         return None
 
     try:
-        if resource_changes:
-            stop_op = instance_service.Stop(StopInstanceRequest(instance_id=instance.id))
-            sdk.wait_operation_and_get_result(stop_op)
-
-        update_request = UpdateInstanceRequest(
-            instance_id=instance.id,
-            update_mask=update_mask,
-            **request_fields
-        )
+        if stop:
+            run_operation(
+                sdk, deadline, "stop",
+                lambda: instance_service.Stop(StopInstanceRequest(instance_id=instance.id)),
+            )
+
+        if update_mask.paths:
+            update_request = UpdateInstanceRequest(
+                instance_id=instance.id,
+                update_mask=update_mask,
+                **request_fields
+            )
 
-        update_op = instance_service.Update(update_request)
-        sdk.wait_operation_and_get_result(update_op)
+            run_operation(sdk, deadline, "update", lambda: instance_service.Update(update_request))
 
-        if resource_changes:
-            start_op = instance_service.Start(StartInstanceRequest(instance_id=instance.id))
-            sdk.wait_operation_and_get_result(start_op)
+        for op in nic_ops:
+            run_nic_op(sdk, instance_service, instance, op, deadline)
+
+        if start:
+            run_operation(
+                sdk, deadline, "start",
+                lambda: instance_service.Start(StartInstanceRequest(instance_id=instance.id)),
+            )
 
         return None
     except Exception as e:
-        if resource_changes:
+        # Запускаем обратно только VM, которую остановили сами; после истечения бюджета
+        # не запускаем - Start тоже не успеет
+        if stop and not isinstance(e, OperationTimeout):
             try:
-                start_op = instance_service.Start(StartInstanceRequest(instance_id=instance.id))
-                sdk.wait_operation_and_get_result(start_op)
+                run_operation(
+                    sdk, deadline, "start",
+                    lambda: instance_service.Start(StartInstanceRequest(instance_id=instance.id)),
+                )
             except:
                 pass
         return e
 
-def apply_vm_diff(sdk, instance_service, vm_spec: Dict, instance: Instance | None, vm_diff: Dict) -> Dict:
+def apply_vm_diff(sdk, instance_service, vm_spec: Dict, instance: Instance | None, vm_diff: Dict, deadline: Deadline) -> Dict:
     result = vm_diff.copy()
 
     if not vm_diff["changed"]:
@@ -759,17 +1583,17 @@ def apply_vm_diff(sdk, instance_service, vm_spec: Dict, instance: Instance | Non
             required_action = VMAction.RESTART
 
         if required_action == VMAction.CREATE:
-            res = create_instance(sdk, instance_service, vm_spec, None)
+            res = create_instance(sdk, instance_service, vm_spec, None, deadline)
             if res:
-                result["status"] = "error"
+                result["status"] = error_status(res)
                 result["error"] = str(res)
             else:
                 result["status"] = "created"
 
         elif required_action == VMAction.RECREATE:
-            res = create_instance(sdk, instance_service, vm_spec, instance)
+            res = create_instance(sdk, instance_service, vm_spec, instance, deadline)
             if res:
-                result["status"] = "error"
+                result["status"] = error_status(res)
                 result["error"] = str(res)
             else:
                 result["status"] = "recreated"
@@ -777,9 +1601,9 @@ def apply_vm_diff(sdk, instance_service, vm_spec: Dict, instance: Instance | Non
         elif required_action == VMAction.RESTART:
             if instance:
 
-                res = update_instance(sdk, instance_service, vm_spec, instance, vm_diff)
+                res = update_instance(sdk, instance_service, vm_spec, instance, vm_diff, deadline)
                 if res:
-                    result["status"] = "error"
+                    result["status"] = error_status(res)
                     result["error"] = str(res)
                 else:
                     result["status"] = "restarted"
@@ -789,9 +1613,9 @@ def apply_vm_diff(sdk, instance_service, vm_spec: Dict, instance: Instance | Non
 
         elif required_action == VMAction.INPLACE:
             if instance:
-                res = update_instance(sdk, instance_service, vm_spec, instance, vm_diff)
+                res = update_instance(sdk, instance_service, vm_spec, instance, vm_diff, deadline)
                 if res:
-                    result["status"] = "error"
+                    result["status"] = error_status(res)
                     result["error"] = str(res)
                 else:
                     result["status"] = "updated_in_place"
@@ -800,7 +1624,7 @@ def apply_vm_diff(sdk, instance_service, vm_spec: Dict, instance: Instance | Non
                 result["error"] = "Instance not found for update"
 
     except Exception as e:
-        result["status"] = "error"
+        result["status"] = error_status(e)
         result["error"] = str(e)
 
     # Очищаем вывод - оставляем только нужные поля
@@ -818,7 +1642,7 @@ def apply_vm_diff(sdk, instance_service, vm_spec: Dict, instance: Instance | Non
 
     return clean_result
 
-def process_vm(sdk, instance_service, module, instances, vm):
+def plan_vm(sdk, instances, vm, ensure_running=False):
 
     # Берём только явно указанные поля
     original_vm_args = getattr(vm, "_original_args", vm)
@@ -833,19 +1657,35 @@ def process_vm(sdk, instance_service, module, instances, vm):
 
     # Проверка флагов force_recreate/force_restart
     if vm_diff["actions"][VMAction.RECREATE.value] and not vm.get("force_recreate", False):
-        module.fail_json(
-            msg="Changes require VM recreation (use force_recreate to allow)",
+        raise YCModuleError(
+            "Changes require VM recreation (use force_recreate to allow)",
             diff=vm_diff,
         )
     if vm_diff["actions"][VMAction.RESTART.value] and not vm.get("force_restart", False):
-        module.fail_json(
-            msg="Changes require VM restart (use force_restart to allow)",
+        raise YCModuleError(
+            "Changes require VM restart (use force_restart to allow)",
             diff=vm_diff,
         )
 
-    if not module.check_mode:
-        vm["folder_id"] = module.params['folder_id']
-        vm_diff = apply_vm_diff(sdk, instance_service, vm, instance, vm_diff)
+    # Запуск остановленных VM выполняет apply_folder - сразу для всех VM каталога
+    if ensure_running and instance is not None and instance.status == Instance.Status.STOPPED:
+        vm_diff["start"] = True
+        vm_diff["changed"] = True
+        vm_diff["changes"].append("status: STOPPED -> RUNNING")
+
+    return instance, vm_diff
+
+def process_vm(sdk, instance_service, check_mode, instance, vm, vm_diff, deadline):
+
+    if not check_mode:
+        if vm_diff["changed"] and deadline.expired():
+            return {
+                "name": vm_diff.get("name"),
+                "changed": False,
+                "status": "not_started",
+                "changes": vm_diff["changes"],
+            }
+        vm_diff = apply_vm_diff(sdk, instance_service, vm, instance, vm_diff, deadline)
     else:
         status_info = "would be changed" if vm_diff["changed"] else "no changes"
 
@@ -855,6 +1695,8 @@ def process_vm(sdk, instance_service, module, instances, vm):
             status_info += " (requires recreate)"
         elif vm_diff["actions"][VMAction.CREATE.value]:
             status_info += " (requires create)"
+        elif vm_diff.get("start"):
+            status_info += " (requires start)"
 
         clean_vm_diff = {
             "name": vm_diff.get("name"),
@@ -869,52 +1711,321 @@ def process_vm(sdk, instance_service, module, instances, vm):
 
     return vm_diff
 
-def run_module():
-
-    module = AnsibleModule(
-        argument_spec = build_arguments(FIELDS_SPEC),
-        supports_check_mode=True
+def scan_folder(instance_service, folder_id, deadline=None):
+    timeout = deadline.remaining() if deadline else None
 
+    # Получаем короткий список
+    short_instances = instance_service.List(
+        ListInstancesRequest(folder_id=folder_id), timeout=timeout
     )
 
+    # Список полных объектов
+    return [
+        instance_service.Get(
+            GetInstanceRequest(instance_id=inst.id, view=InstanceView.FULL ),
+            timeout=deadline.remaining() if deadline else None,
+        )
+        for inst in short_instances.instances
+    ]
 
-    token = module.params['token']
-    folder_id = module.params['folder_id']
-    skey_file = module.params['service_key_file']
+def group_vms_by_folder(vms, default_folder_id):
+    #
+    # Раскладывает VM по каталогам: {folder_id: [(index, vm), ...]}
+    # Индекс нужен, чтобы собрать итоговый отчет в порядке параметра vms
+    #
+    folders: Dict[str, list] = {}
+    for index, vm in enumerate(vms):
+        folder_id = vm.get("folder_id") or default_folder_id
+        if not folder_id:
+            raise YCModuleError(f"VM {vm['name']}: folder_id is not set (neither for the VM nor at the top level)")
+        vm["folder_id"] = folder_id
+        folders.setdefault(folder_id, []).append((index, vm))
+    return folders
+
+class FolderCache:
+    #
+    # Кэш сканов каталогов для worker: {folder_id: (время скана, instances)}
+    #
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def scan(self, instance_service, folder_id, deadline=None):
+        with self.lock:
+            entry = self.entries.get(folder_id)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            return entry[1]
+
+        instances = scan_folder(instance_service, folder_id, deadline)
+        with self.lock:
+            self.entries[folder_id] = (time.monotonic(), instances)
+        return instances
+
+    def invalidate(self, folder_id):
+        with self.lock:
+            self.entries.pop(folder_id, None)
+
+def plan_folder(sdk, instance_service, folder_id, indexed_vms, deadline, folder_cache=None, ensure_running=False):
+    #
+    # Если бюджет кончился до или во время скана, VM каталога попадают в отчет
+    # как not_started (план None), а не роняют всю задачу
+    #
+    if deadline.expired():
+        return [(index, vm, None, None) for index, vm in indexed_vms]
+    try:
+        if folder_cache:
+            instances = folder_cache.scan(instance_service, folder_id, deadline)
+        else:
+            instances = scan_folder(instance_service, folder_id, deadline)
+    except grpc.RpcError as e:
+        if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED and deadline.remaining() is not None:
+            return [(index, vm, None, None) for index, vm in indexed_vms]
+        raise YCModuleError(f"Folder {folder_id} scan failed: {e.code().name}: {e.details()}")
+    plans = []
+    for index, vm in indexed_vms:
+        instance, vm_diff = plan_vm(sdk, instances, vm, ensure_running)
+        plans.append((index, vm, instance, vm_diff))
+    return plans
+
+def instance_addresses(instance):
+    info = {
+        "id": instance.id,
+        "fqdn": instance.fqdn,
+        "internal_ip": None,
+        "external_ip": None,
+    }
+    if instance.network_interfaces:
+        address = instance.network_interfaces[0].primary_v4_address
+        info["internal_ip"] = address.address or None
+        info["external_ip"] = address.one_to_one_nat.address or None
+    return info
+
+def probe_port(host, port, until):
+    while time.monotonic() < until:
+        try:
+            with socket.create_connection((host, port), timeout=min(3, max(until - time.monotonic(), 0.1))):
+                return True
+        except OSError:
+            time.sleep(1)
+    return False
 
-    retry_policy = RetryPolicy(
-        max_attempts=5,
-        status_codes=(grpc.StatusCode.UNAVAILABLE,)
-    )
+def wait_folder_ready(instance_service, folder_id, ready_queue, expected, wait_options, deadline):
+    #
+    # VM приходят из ready_queue по мере завершения своих операций: (name, время начала операций)
+    # или (name, None), если ждать ее не нужно. Один List каталога на раунд опроса; каждая VM
+    # отмечается готовой сразу, как только получила RUNNING (и открытый порт для ssh).
+    # ready_time считается от начала операций VM, wait_for_timeout - от ее поступления
+    #
+    started = {}
+    until = {}
+    ready = {}
+    probes = {}
+    last_seen = {}
+    received = 0
+
+    def pending():
+        now = time.monotonic()
+        return {name for name in started if name not in ready and now < until[name]}
+
+    with ThreadPoolExecutor(max_workers=max(1, expected)) as probe_executor:
+        while True:
+            # Пока ждать некого, блокируемся на очереди, а не опрашиваем API
+            while received < expected:
+                try:
+                    name, operation_started = ready_queue.get(block=not pending(), timeout=2)
+                except queue.Empty:
+                    break
+                received += 1
+                if operation_started is None:
+                    continue
+                started[name] = operation_started
+                until[name] = time.monotonic() + wait_options["timeout"]
+                if deadline.remaining() is not None:
+                    until[name] = min(until[name], time.monotonic() + deadline.remaining())
 
-    if token:
-        sdk = SDK(token=token, retry_policy=retry_policy)
-    else:
-        with open(skey_file) as infile:
-            sdk = SDK(service_account_key=json.load(infile), retry_policy=retry_policy)
+            waiting = pending()
+            if not waiting:
+                if received == expected:
+                    break
+                continue
 
-    instance_service = sdk.client(InstanceServiceStub)
+            try:
+                listed = instance_service.List(
+                    ListInstancesRequest(folder_id=folder_id),
+                    timeout=max(max(until[name] for name in waiting) - time.monotonic(), 0.1),
+                ).instances
+            except grpc.RpcError:
+                listed = []
+
+            for instance in listed:
+                if instance.name not in waiting:
+                    continue
+                last_seen[instance.name] = instance
+                if instance.status != Instance.Status.RUNNING:
+                    continue
+                if wait_options["mode"] == "running":
+                    ready[instance.name] = time.monotonic() - started[instance.name]
+                elif instance.name not in probes:
+                    info = instance_addresses(instance)
+                    host = info["external_ip"] or info["internal_ip"]
+                    if host:
+                        probes[instance.name] = probe_executor.submit(
+                            probe_port, host, wait_options["port"], until[instance.name],
+                        )
 
-    # Получаем короткий список
-    short_instances = instance_service.List(
-        ListInstancesRequest(folder_id=folder_id)
-    )
+            for name, probe in probes.items():
+                if name not in ready and probe.done() and probe.result():
+                    ready[name] = time.monotonic() - started[name]
+
+            if pending():
+                time.sleep(2)
+
+    report = {}
+    for name in started:
+        instance = last_seen.get(name)
+        entry = {"ready": name in ready}
+        if name in ready:
+            entry["ready_time"] = round(ready[name], 1)
+        if instance is not None:
+            entry["instance_status"] = Instance.Status.Name(instance.status)
+            entry.update(instance_addresses(instance))
+        report[name] = entry
+    return report
+
+def start_instance(sdk, instance_service, instance, deadline):
+    try:
+        run_operation(
+            sdk, deadline, "start",
+            lambda: instance_service.Start(StartInstanceRequest(instance_id=instance.id)),
+            meta_type=StartInstanceMetadata,
+        )
+    except Exception as e:
+        return e
+    return None
 
-    # Список полных объектов
-    instances = [
-        instance_service.Get(GetInstanceRequest(instance_id=inst.id, view=InstanceView.FULL ))
-        for inst in short_instances.instances
-    ]
+def apply_vm(sdk, instance_service, check_mode, folder_id, plan, deadline, ready_queue=None):
+    #
+    # Операции одной VM идут по очереди: изменения, диски, запуск. Как только они завершились,
+    # VM передается в ready_queue со временем начала своих операций - ожидание готовности
+    # не ждет остальные VM каталога
+    #
+    index, vm, instance, vm_diff = plan
+    operation_started = time.monotonic()
+    wait_from = None
+    try:
+        if vm_diff is None:
+            return index, {
+                "name": vm["name"],
+                "folder_id": folder_id,
+                "changed": False,
+                "status": "not_started",
+                "error": f"Folder {folder_id} was not scanned, task timeout exceeded",
+            }
+        vm_result = process_vm(sdk, instance_service, check_mode, instance, vm, vm_diff, deadline)
+        vm_result["folder_id"] = folder_id
+        if check_mode:
+            return index, vm_result
+
+        applied = vm_result.get("status") in ("updated_in_place", "restarted")
+        # Созданная или пересозданная VM получает диски сразу в CreateInstanceRequest
+        if vm_diff.get("disk_ops") and applied:
+            error = run_disk_ops(sdk, instance_service, instance, vm_diff["disk_ops"], deadline)
+            if error:
+                vm_result["status"] = error_status(error)
+                vm_result["error"] = str(error)
+        # Пересозданная VM уже запущена, а update_instance при needs_stop сам делает Stop/Start
+        # (и Start остановленной VM, если он запрошен)
+        if vm_diff.get("start") and not needs_stop(vm_diff) and applied:
+            error = start_instance(sdk, instance_service, instance, deadline)
+            if error:
+                vm_result["status"] = error_status(error)
+                vm_result["error"] = str(error)
+            elif vm_result["status"] == "updated_in_place" and vm_result.get("changes") == ["status: STOPPED -> RUNNING"]:
+                vm_result["status"] = "started"
+
+        if vm_result.get("status") not in ("error", "timeout", "interrupted", "not_started"):
+            wait_from = operation_started
+        return index, vm_result
+    finally:
+        # Ожидание готовности считает поступившие VM, поэтому отметка нужна при любом исходе
+        if ready_queue is not None:
+            ready_queue.put((vm["name"], wait_from))
+
+def apply_folder(sdk, instance_service, check_mode, folder_id, plans, deadline, folder_cache=None, wait_options=None):
+    #
+    # VM каталога обрабатываются одновременно, одна задача на VM; ожидание готовности
+    # идет параллельно с ними и начинается для каждой VM сразу после ее операций
+    #
+    ready_queue = queue.Queue() if wait_options and not check_mode else None
+    with ThreadPoolExecutor(max_workers=max(1, len(plans)) + 1) as executor:
+        waiting = None
+        if ready_queue is not None:
+            waiting = executor.submit(
+                wait_folder_ready, instance_service, folder_id, ready_queue, len(plans), wait_options, deadline,
+            )
+        results = list(executor.map(
+            lambda plan: apply_vm(sdk, instance_service, check_mode, folder_id, plan, deadline, ready_queue),
+            plans,
+        ))
+        readiness = waiting.result() if waiting else {}
+    for _, vm_result in results:
+        vm_result.update(readiness.get(vm_result["name"], {}))
+
+    # После изменений скан каталога устарел
+    if folder_cache and not check_mode and any(vm_diff and vm_diff["changed"] for _, _, _, vm_diff in plans):
+        folder_cache.invalidate(folder_id)
+    return results
+
+def reconcile(sdk, params, check_mode, folder_cache=None):
+    #
+    # Сначала параллельно сканируем все каталоги и строим diff для всех VM,
+    # и только если ни одна VM не требует запрещенного действия - параллельно применяем
+    #
+    deadline = Deadline(params["timeout"], params["operation_timeouts"])
+    wait_options = None
+    if params["wait_for"] != "none":
+        wait_options = {
+            "mode": params["wait_for"],
+            "port": params["wait_for_port"],
+            "timeout": params["wait_for_timeout"],
+        }
+    instance_services = instance_service_pool(sdk, params["grpc_channels"])
+    folders = group_vms_by_folder(params["vms"] or [], params["folder_id"])
+    if not folders:
+        return {"instances": [], "timed_out": False}
+    # Каталоги по кругу раскладываются по каналам пула
+    folder_services = {
+        folder_id: instance_services[n % len(instance_services)]
+        for n, folder_id in enumerate(folders)
+    }
 
-    result_instances = []
-    for vm in module.params["vms"]:
-        vm_diff = process_vm(sdk, instance_service, module, instances, vm)
-        result_instances.append(vm_diff)
+    workers = max(1, min(params["max_workers"], len(folders)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        plans = dict(zip(folders, executor.map(
+            lambda folder_id: plan_folder(
+                sdk, folder_services[folder_id], folder_id, folders[folder_id], deadline, folder_cache,
+                params["ensure_running"],
+            ),
+            folders,
+        )))
+        applied = executor.map(
+            lambda folder_id: apply_folder(
+                sdk, folder_services[folder_id], check_mode, folder_id, plans[folder_id],
+                deadline, folder_cache, wait_options,
+            ),
+            plans,
+        )
+        result_instances = [vm_result for _, vm_result in sorted(
+            (item for folder_results in applied for item in folder_results),
+            key=lambda item: item[0],
+        )]
 
     final_instances = []
     for vm_result in result_instances:
         clean_result = {
             "name": vm_result.get("name"),
+            "folder_id": vm_result.get("folder_id"),
             "changed": vm_result.get("changed", False),
             "status": vm_result.get("status", "unknown")
         }
@@ -925,12 +2036,360 @@ def run_module():
         if "error" in vm_result:
             clean_result["error"] = vm_result["error"]
 
+        for field in ("ready", "ready_time", "instance_status", "id", "fqdn", "internal_ip", "external_ip"):
+            if field in vm_result:
+                clean_result[field] = vm_result[field]
+
         final_instances.append(clean_result)
 
-    module.exit_json(
+    timed_out = deadline.expired() and any(
+        vm["status"] in ("timeout", "interrupted", "not_started") for vm in final_instances
+    )
+    return {"instances": final_instances, "timed_out": timed_out}
+
+def progress_report(instances):
+    report = {"completed": [], "in_progress": [], "interrupted": [], "not_started": []}
+    for vm in instances:
+        if vm["status"] == "timeout":
+            report["in_progress"].append(vm["name"])
+        elif vm["status"] == "interrupted":
+            report["interrupted"].append(vm["name"])
+        elif vm["status"] == "not_started":
+            report["not_started"].append(vm["name"])
+        else:
+            report["completed"].append(vm["name"])
+    return report
+
+def read_service_key(params):
+    with open(params['service_key_file']) as infile:
+        return json.load(infile)
+
+GRPC_CHANNEL_PARAMS = (
+    "grpc_keepalive_time",
+    "grpc_compression",
+    "grpc_max_receive_size",
+    "grpc_call_timeout",
+    "grpc_channels",
+)
+
+class CallDetails(
+    collections.namedtuple(
+        "CallDetails",
+        ("method", "timeout", "metadata", "credentials", "wait_for_ready", "compression"),
+    ),
+    grpc.ClientCallDetails,
+):
+    pass
+
+class CallDeadlineInterceptor(grpc.UnaryUnaryClientInterceptor):
+    #
+    # Проставляет deadline вызовам, у которых он не задан явно
+    #
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        if client_call_details.timeout is None:
+            client_call_details = CallDetails(
+                client_call_details.method,
+                self.timeout,
+                client_call_details.metadata,
+                client_call_details.credentials,
+                getattr(client_call_details, "wait_for_ready", None),
+                getattr(client_call_details, "compression", None),
+            )
+        return continuation(client_call_details, request)
+
+def grpc_channel_options(params):
+    options = []
+    if params["grpc_keepalive_time"]:
+        options += [
+            ("grpc.keepalive_time_ms", params["grpc_keepalive_time"] * 1000),
+            ("grpc.keepalive_timeout_ms", 20000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+    if params["grpc_compression"] == "gzip":
+        options.append(("grpc.default_compression_algorithm", int(grpc.Compression.Gzip)))
+    if params["grpc_max_receive_size"]:
+        options.append(("grpc.max_receive_message_length", params["grpc_max_receive_size"] * 1024**2))
+    if params["grpc_channels"] > 1:
+        # Иначе каналы с одинаковыми опциями делят одно соединение
+        options.append(("grpc.use_local_subchannel_pool", 1))
+    return options
+
+YANDEXCLOUD_REQUIREMENT = "yandexcloud>=0.411,<0.412"
+
+def check_sdk_internals(sdk, names):
+    #
+    # Пул каналов и опции каналов опираются на внутренности SDK, публичного API для них нет.
+    # В другой версии SDK их может не быть - тогда понятная ошибка вместо AttributeError
+    #
+    missing = []
+    for name in names:
+        obj = sdk
+        for part in name.split("."):
+            if not hasattr(obj, part):
+                missing.append(name)
+                break
+            obj = getattr(obj, part)
+    if missing:
+        raise YCModuleError(
+            f"yandexcloud {getattr(yandexcloud, '__version__', 'unknown')} is not supported: "
+            f"SDK has no {', '.join(missing)}; install {YANDEXCLOUD_REQUIREMENT}"
+        )
+
+def instance_service_pool(sdk, size):
+    #
+    # Первый канал - обычный кэшируемый канал SDK, остальные открываются отдельно
+    #
+    services = [sdk.client(InstanceServiceStub)]
+    if size > 1:
+        check_sdk_internals(sdk, ("_channels._create_channel", "_default_interceptor"))
+    for _ in range(size - 1):
+        channel = sdk._channels._create_channel("compute")
+        if sdk._default_interceptor is not None:
+            channel = grpc.intercept_channel(channel, sdk._default_interceptor)
+        services.append(InstanceServiceStub(channel))
+    return services
+
+def build_sdk(params):
+    token = params['token']
+
+    retry_policy = RetryPolicy(
+        max_attempts=5,
+        status_codes=(grpc.StatusCode.UNAVAILABLE,)
+    )
+    interceptor = CallDeadlineInterceptor(params["grpc_call_timeout"]) if params["grpc_call_timeout"] else None
+
+    if token:
+        sdk = SDK(token=token, retry_policy=retry_policy, interceptor=interceptor)
+    else:
+        sdk = SDK(service_account_key=read_service_key(params), retry_policy=retry_policy, interceptor=interceptor)
+
+    # SDK не принимает опции каналов в конструкторе, но читает channel_options
+    # при открытии каждого канала - дополняем их до первого вызова
+    options = grpc_channel_options(params)
+    if options:
+        check_sdk_internals(sdk, ("_channels.channel_options",))
+        sdk._channels.channel_options += tuple(options)
+    return sdk
+
+def sdk_cache_key(params):
+    # Один SDK (и его каналы/IAM токен) на набор учетных данных и настроек каналов
+    credentials = params['token'] or read_service_key(params)
+    channel_params = [params[name] for name in GRPC_CHANNEL_PARAMS]
+    return hashlib.sha256(json.dumps([credentials, channel_params], sort_keys=True).encode()).hexdigest()
+
+class YCWorkerHandler(socketserver.StreamRequestHandler):
+    #
+    # Одна строка JSON запроса -> одна строка JSON ответа
+    #
+    def handle(self):
+        # Запросы только от процессов того же пользователя
+        if peer_uid(self.connection) != os.getuid():
+            return
+        server = self.server
+        request = json.loads(self.rfile.readline())
+        params = request["params"]
+        try:
+            sdk, folder_cache = server.get_sdk(params)
+            folder_cache.ttl = params["worker_cache_ttl"]
+            response = reconcile(sdk, params, request["check_mode"], folder_cache)
+        except YCModuleError as e:
+            response = dict(e.kwargs, failed=True, msg=e.msg)
+        except Exception as e:
+            response = {"failed": True, "msg": f"yc worker: {e}"}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+class YCWorker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, idle_timeout):
+        super().__init__(socket_path, YCWorkerHandler)
+        self.idle_timeout = idle_timeout
+        self.timeout = 1
+        self.lock = threading.Lock()
+        self.active = 0
+        self.last_request = time.monotonic()
+        self.sdks = {}
+
+    def process_request(self, request, client_address):
+        #
+        # Запрос считается активным уже в главном потоке, до запуска потока обработчика:
+        # иначе idle() между accept и стартом потока завершит worker посреди запроса
+        #
+        with self.lock:
+            self.active += 1
+            self.last_request = time.monotonic()
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self.request_done()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.request_done()
+
+    def request_done(self):
+        with self.lock:
+            self.active -= 1
+            self.last_request = time.monotonic()
+
+    def get_sdk(self, params):
+        key = sdk_cache_key(params)
+        with self.lock:
+            if key not in self.sdks:
+                self.sdks[key] = (build_sdk(params), FolderCache(params["worker_cache_ttl"]))
+            return self.sdks[key]
+
+    def idle(self):
+        with self.lock:
+            return self.active == 0 and time.monotonic() - self.last_request >= self.idle_timeout
+
+    def serve_until_idle(self):
+        while not self.idle():
+            self.handle_request()
+
+def private_dir(path):
+    #
+    # Каталог сокета и lock: создаем с 0700 и проверяем, что это не symlink, он наш
+    # и закрыт для группы и остальных - иначе сокет может подменить другой пользователь
+    #
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} must be a directory owned by uid {os.getuid()} with mode 0700")
+    return path
+
+def module_fingerprint():
+    #
+    # Хэш исходного кода модуля. Worker, запущенный из AnsiballZ, продолжает выполнять
+    # свою версию кода, поэтому после обновления коллекции нужен другой сокет
+    #
+    try:
+        source = __loader__.get_source(__spec__.name if __spec__ else __name__)
+    except Exception:
+        source = None
+    if source is None:
+        with open(__file__, "rb") as f:
+            source = f.read().decode("utf-8")
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:12]
+
+def default_worker_socket():
+    base = os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser("~/.ansible")
+    return os.path.join(base, "yc-worker", f"yc-worker-{module_fingerprint()}.sock")
+
+def peer_uid(sock):
+    # SO_PEERCRED: struct ucred {pid, uid, gid}
+    _, uid, _ = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+def serve_worker(socket_path, idle_timeout):
+    #
+    # Только один worker на сокет: второй процесс не получит lock и сразу выйдет
+    #
+    with open(socket_path + ".lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        os.umask(0o077)
+        server = YCWorker(socket_path, idle_timeout)
+        try:
+            server.serve_until_idle()
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+
+def spawn_worker(socket_path, idle_timeout):
+    #
+    # Двойной fork: worker отвязывается от процесса модуля и от stdout Ansible
+    #
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        serve_worker(socket_path, idle_timeout)
+    finally:
+        os._exit(0)
+
+def call_worker(params, check_mode, start_timeout=10):
+    socket_path = os.path.abspath(os.path.expanduser(params['worker_socket'] or default_worker_socket()))
+    private_dir(os.path.dirname(socket_path))
+    payload = json.dumps({"params": params, "check_mode": check_mode}).encode() + b"\n"
+
+    deadline = None
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if deadline is None:
+                spawn_worker(socket_path, params['worker_idle_timeout'])
+                deadline = time.monotonic() + start_timeout
+            elif time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+    with sock:
+        # Параметры с token уходят только worker того же пользователя
+        if peer_uid(sock) != os.getuid():
+            raise PermissionError(f"{socket_path} is served by another user")
+        sock.sendall(payload)
+        sock.shutdown(socket.SHUT_WR)
+        return json.loads(sock.makefile("rb").readline())
+
+def run_module():
+
+    module = AnsibleModule(
+        argument_spec = build_arguments(FIELDS_SPEC),
+        supports_check_mode=True
+
+    )
+
+    if module.params['worker']:
+        try:
+            response = call_worker(module.params, module.check_mode)
+        except (OSError, ValueError) as e:
+            module.fail_json(msg=f"yc worker is not available: {e}")
+        if response.pop("failed", False):
+            module.fail_json(**response)
+    else:
+        try:
+            sdk = build_sdk(module.params)
+            response = reconcile(sdk, module.params, module.check_mode)
+        except YCModuleError as e:
+            module.fail_json(msg=e.msg, **e.kwargs)
+
+    final_instances = response["instances"]
+    result = dict(
         changed=any(vm.get("changed", False) for vm in final_instances),
         instances=final_instances,
+        **progress_report(final_instances)
     )
+    if module.params["wait_for"] != "none" and not module.check_mode:
+        result["not_ready"] = [vm["name"] for vm in final_instances if not vm.get("ready", False)]
+    if response["timed_out"]:
+        module.fail_json(msg=f"Task timeout of {module.params['timeout']}s exceeded", **result)
+
+    module.exit_json(**result)
 
 
 def main():
@@ -0,0 +1,26 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+#
+# Модули коллекции импортируются напрямую из plugins/modules, без установки коллекции.
+# Запуск: python -m pytest tests/unit
+#
+from __future__ import annotations
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+sys.path.insert(0, os.path.join(ROOT, 'plugins', 'modules'))
+
+
+@pytest.fixture(scope='session')
+def action_plugin():
+    # Action plugin называется так же, как модуль, поэтому загружается под своим именем
+    spec = importlib.util.spec_from_file_location(
+        'my_own_module_action', os.path.join(ROOT, 'plugins', 'action', 'my_own_module.py'),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
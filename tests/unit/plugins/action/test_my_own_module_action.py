@@ -0,0 +1,92 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import annotations
+
+import contextlib
+import io
+import json
+import os
+import random
+import types
+
+import pytest
+from ansible.module_utils import basic
+
+import my_own_module
+
+try:
+    from ansible.module_utils.testing import patch_module_args
+except ImportError:
+    # ansible-core < 2.19 читает аргументы из basic._ANSIBLE_ARGS
+    @contextlib.contextmanager
+    def patch_module_args(args):
+        basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=args)).encode('utf-8')
+        yield
+
+
+@pytest.fixture
+def action(action_plugin, monkeypatch):
+    #
+    # ActionModule без TaskExecutor: _execute_module выполняет модуль в этом же процессе
+    # и запоминает аргументы каждого вызова
+    #
+    monkeypatch.setattr(action_plugin.ActionBase, 'run', lambda self, tmp=None, task_vars=None: {})
+
+    def make(args, check_mode=False):
+        plugin = object.__new__(action_plugin.ActionModule)
+        plugin._task = types.SimpleNamespace(
+            args=args, resolved_action='my_own_module', action='my_own_module', diff=False,
+        )
+        plugin._play_context = types.SimpleNamespace(check_mode=check_mode)
+        plugin.calls = []
+
+        def execute_module(module_name, module_args, task_vars):
+            plugin.calls.append(module_args)
+            output = io.StringIO()
+            with patch_module_args(dict(module_args, _ansible_check_mode=check_mode)), \
+                    contextlib.redirect_stdout(output), pytest.raises(SystemExit):
+                my_own_module.run_module()
+            return json.loads(output.getvalue())
+
+        plugin._execute_module = execute_module
+        return plugin
+    return make
+
+
+def test_small_content_goes_in_one_call(action, tmp_path):
+    path = str(tmp_path / 'small.txt')
+    for changed in (True, False):
+        plugin = action(dict(path=path, content='small\n'))
+        assert plugin.run(task_vars={})['changed'] is changed
+        assert len(plugin.calls) == 1
+        assert plugin.calls[0]['content'] == 'small\n'
+
+
+def test_big_content_is_sent_only_when_it_differs(action, action_plugin, tmp_path):
+    path = str(tmp_path / 'big.txt')
+    content = 'x' * (action_plugin.PROBE_MIN_CONTENT * 2)
+
+    plugin = action(dict(path=path, content=content))
+    assert plugin.run(task_vars={})['created']
+    assert len(plugin.calls) == 2
+    assert 'content' not in plugin.calls[0]
+
+    plugin = action(dict(path=path, content=content))
+    assert not plugin.run(task_vars={})['changed']
+    assert len(plugin.calls) == 1
+
+
+def test_delta_on_hard_linked_file_needs_no_retry(action, tmp_path):
+    path = tmp_path / 'linked.txt'
+    old = random.Random(0).randbytes(200 * 1024).hex()
+    path.write_text(old)
+    os.link(path, tmp_path / 'other-link.txt')
+    new = old[:1000] + 'changed' + old[1007:]
+
+    plugin = action(dict(path=str(path), content=new, delta=True))
+    result = plugin.run(task_vars={})
+
+    assert result['updated']
+    # Проба и сразу content - без неудачной delta и третьего вызова
+    assert len(plugin.calls) == 2
+    assert 'delta_ops' not in plugin.calls[1]
+    assert (tmp_path / 'other-link.txt').read_text() == new
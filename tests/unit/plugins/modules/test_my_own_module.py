@@ -0,0 +1,461 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import annotations
+
+import base64
+import contextlib
+import difflib
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import stat
+import time
+
+import pytest
+from ansible.module_utils import basic
+
+import my_own_module as m
+
+try:
+    from ansible.module_utils.testing import patch_module_args
+except ImportError:
+    # ansible-core < 2.19 читает аргументы из basic._ANSIBLE_ARGS
+    @contextlib.contextmanager
+    def patch_module_args(args):
+        basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=args)).encode('utf-8')
+        yield
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+#
+# delta
+#
+@pytest.fixture
+def delta_file(tmp_path):
+    path = tmp_path / 'big.bin'
+    path.write_bytes(random_bytes(300 * 1024))
+    return path
+
+
+def make_delta(action_plugin, path, new):
+    signatures = m.block_signatures(str(path), m.delta_block_size(path.stat().st_size))
+    return action_plugin.compute_delta(new, signatures), signatures['block_size']
+
+
+def test_delta_round_trip_with_shifted_content(action_plugin, delta_file):
+    old = delta_file.read_bytes()
+    # Вставка в начало сдвигает все блоки - их находит скользящая сумма
+    new = b'inserted' + old[:100000] + b'changed' + old[100007:]
+    ops, block_size = make_delta(action_plugin, delta_file, new)
+    assert ops is not None
+    assert any(op[0] == 'copy' for op in ops)
+    inode = delta_file.stat().st_ino
+
+    written = m.apply_delta(str(delta_file), ops, block_size, sha256(new), m.FileWriter(), m.FileAttributes())
+
+    assert written == 'rewrite'
+    assert delta_file.read_bytes() == new
+    assert delta_file.stat().st_ino != inode
+
+
+def test_delta_in_place_only_when_requested(action_plugin, delta_file):
+    old = delta_file.read_bytes()
+    new = old[:70000] + b'X' * 10 + old[70010:]
+    ops, block_size = make_delta(action_plugin, delta_file, new)
+    inode = delta_file.stat().st_ino
+
+    written = m.apply_delta(
+        str(delta_file), ops, block_size, sha256(new), m.FileWriter(), m.FileAttributes(), allow_in_place=True,
+    )
+
+    assert written == 'in_place'
+    assert delta_file.read_bytes() == new
+    assert delta_file.stat().st_ino == inode
+
+
+def test_delta_checksum_mismatch_writes_nothing(action_plugin, delta_file):
+    old = delta_file.read_bytes()
+    new = old[:5000] + b'new' + old[5003:]
+    ops, block_size = make_delta(action_plugin, delta_file, new)
+
+    written = m.apply_delta(str(delta_file), ops, block_size, sha256(b'other'), m.FileWriter(), m.FileAttributes())
+
+    assert written is None
+    assert delta_file.read_bytes() == old
+
+
+def test_delta_does_not_pay_off_for_new_content(action_plugin, delta_file):
+    ops, _ = make_delta(action_plugin, delta_file, random_bytes(300 * 1024, seed=1))
+    assert ops is None
+
+
+def test_delta_on_missing_file_fails(tmp_path):
+    result = m.apply_file(
+        str(tmp_path / 'missing'), None, False, m.FileWriter(), sha256(b'x'),
+        delta=True, block_size=65536, delta_ops=[['data', 'eA==']],
+    )
+    assert result['delta_failed']
+
+
+def test_probe_returns_signatures_only_when_delta_can_be_written(delta_file):
+    writer = m.FileWriter()
+    probe = m.apply_file(str(delta_file), None, False, writer, sha256(b'new'), delta=True)
+    assert probe['content_required']
+    assert 'signatures' in probe
+
+    # Копия разорвала бы hardlink: delta не записать, сразу нужен content
+    os.link(delta_file, str(delta_file) + '.link')
+    probe = m.apply_file(str(delta_file), None, False, writer, sha256(b'new'), delta=True)
+    assert probe['content_required']
+    assert 'signatures' not in probe
+
+
+#
+# content_b64 и сжатие
+#
+def payload_bytes(payload):
+    return b''.join(bytes(chunk) for chunk in payload.chunks())
+
+
+def b64_item(raw, compression):
+    return dict(content_b64=base64.b64encode(raw).decode(), content_compression=compression)
+
+
+@pytest.fixture
+def plaintext():
+    # Больше B64_CHUNK_SIZE и CHUNK_SIZE, чтобы поток шел несколькими кусками
+    return random_bytes(512 * 1024) + b'line of text\n' * 200000
+
+
+def test_gzip_multi_member_stream(plaintext):
+    half = len(plaintext) // 2
+    raw = gzip.compress(plaintext[:half]) + gzip.compress(plaintext[half:])
+    assert payload_bytes(m.Payload.from_item(b64_item(raw, 'gzip'))) == plaintext
+
+
+def test_gzip_truncated_stream_is_an_error(plaintext):
+    raw = gzip.compress(plaintext)
+    with pytest.raises(ValueError, match='truncated gzip'):
+        payload_bytes(m.Payload.from_item(b64_item(raw[:len(raw) // 2], 'gzip')))
+
+
+def test_gzip_trailing_garbage_is_an_error():
+    raw = gzip.compress(b'data') + b'garbage'
+    with pytest.raises(m.PAYLOAD_ERRORS):
+        payload_bytes(m.Payload.from_item(b64_item(raw, 'gzip')))
+
+
+def test_zstd_multi_frame_stream(plaintext):
+    zstandard = pytest.importorskip('zstandard')
+    half = len(plaintext) // 2
+    compressor = zstandard.ZstdCompressor()
+    raw = compressor.compress(plaintext[:half]) + compressor.compress(plaintext[half:])
+    assert payload_bytes(m.Payload.from_item(b64_item(raw, 'zstd'))) == plaintext
+
+
+def test_zstd_truncated_frame_is_an_error(plaintext):
+    zstandard = pytest.importorskip('zstandard')
+    raw = zstandard.ZstdCompressor().compress(plaintext)
+    with pytest.raises(ValueError, match='truncated zstd'):
+        payload_bytes(m.Payload.from_item(b64_item(raw[:-10], 'zstd')))
+
+
+def test_b64_with_line_breaks_and_plain_size():
+    raw = random_bytes(1000)
+    encoded = base64.encodebytes(raw).decode()
+    payload = m.Payload.from_item(dict(content_b64=encoded, content_compression='none'))
+    assert payload.size == len(raw)
+    assert payload_bytes(payload) == raw
+
+
+def test_compressed_payload_written_and_compared(tmp_path, plaintext):
+    path = str(tmp_path / 'file.bin')
+    item = b64_item(gzip.compress(plaintext), 'gzip')
+
+    result = m.apply_file(path, m.Payload.from_item(item), False, m.FileWriter())
+    assert result['created']
+    with open(path, 'rb') as f:
+        assert f.read() == plaintext
+
+    result = m.apply_file(path, m.Payload.from_item(item), False, m.FileWriter())
+    assert not result['changed']
+
+
+def test_controller_plaintext_matches_module(action_plugin, plaintext):
+    raw = gzip.compress(plaintext[:1000]) + gzip.compress(plaintext[1000:])
+    item = b64_item(raw, 'gzip')
+    assert action_plugin.item_plaintext(item) == payload_bytes(m.Payload.from_item(item))
+
+
+#
+# --diff
+#
+def text_payload(text):
+    return m.Payload(data=text.encode())
+
+
+def test_file_diff_matches_difflib(tmp_path):
+    path = tmp_path / 'config.txt'
+    old = [f'line {n}\n' for n in range(200)]
+    new = list(old)
+    new[10] = 'changed\n'
+    del new[50:55]
+    new[120:120] = ['inserted 1\n', 'inserted 2\n']
+    path.write_text(''.join(old))
+
+    prepared = m.file_diff(str(path), text_payload(''.join(new)), True)['prepared']
+
+    expected = ''.join(difflib.unified_diff(old, new, f'before: {path}', f'after: {path}'))
+    assert prepared == expected
+
+
+def test_file_diff_new_file_and_missing_newline(tmp_path):
+    # Файла нет - сравнение с пустым содержимым
+    path = str(tmp_path / 'new.txt')
+    prepared = m.file_diff(path, text_payload('a\nb'), False)['prepared']
+    assert prepared.splitlines()[2:] == ['@@ -0,0 +1,2 @@', '+a', '+b', '\\ No newline at end of file']
+
+
+def test_file_diff_binary_and_limits(tmp_path, monkeypatch):
+    path = tmp_path / 'file'
+    path.write_bytes(b'\0binary')
+    assert 'Binary files differ' in m.file_diff(str(path), text_payload('text\n'), True)['prepared']
+
+    path.write_text('x\n' * 100)
+    monkeypatch.setattr(m, 'DIFF_MAX_LINES', 50)
+    assert 'diff not shown' in m.file_diff(str(path), text_payload('y\n' * 100), True)['prepared']
+
+    monkeypatch.setattr(m, 'DIFF_MAX_LINES', 50000)
+    monkeypatch.setattr(m, 'DIFF_MAX_OUTPUT_LINES', 10)
+    prepared = m.file_diff(str(path), text_payload('y\n' * 100), True)['prepared']
+    assert prepared.endswith('hunks not shown in full\n')
+    assert sum(line[:1] in '+- ' for line in prepared.splitlines()[2:-1]) <= 10
+
+
+def test_line_matcher_opcodes_rebuild_the_new_side():
+    rng = random.Random(2)
+    old = [rng.randrange(30) for _ in range(2000)]
+    new = list(old)
+    for _ in range(100):
+        pos = rng.randrange(len(new))
+        if rng.random() < 0.5:
+            new[pos] = rng.randrange(1000, 2000)
+        else:
+            new.insert(pos, rng.randrange(1000, 2000))
+
+    matcher = m.LineMatcher(None, old, new)
+    rebuilt = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            assert old[i1:i2] == new[j1:j2]
+            rebuilt += old[i1:i2]
+        else:
+            rebuilt += new[j1:j2]
+    assert rebuilt == new
+    # Правки точечные - почти все строки должны совпасть
+    assert sum(block.size for block in matcher.get_matching_blocks()) > len(old) * 0.9
+
+
+#
+# tree
+#
+def run_module(args, check_mode=False):
+    # run_module() целиком, с аргументами как от Ansible; результат - JSON из exit_json/fail_json
+    args = dict(args, _ansible_check_mode=check_mode)
+    output = io.StringIO()
+    with patch_module_args(args), contextlib.redirect_stdout(output), pytest.raises(SystemExit):
+        m.run_module()
+    return json.loads(output.getvalue())
+
+
+def manifest(files):
+    return [dict(path=path, content=content) for path, content in files.items()]
+
+
+def probe_manifest(files):
+    return [dict(path=path, checksum=sha256(content.encode())) for path, content in files.items()]
+
+
+FILES = {'a.txt': 'a\n', 'dir/b.txt': 'b\n', 'dir/sub/c.txt': 'c\n'}
+
+
+def test_tree_created_then_confirmed_from_index(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    result = run_module(dict(tree=str(root), manifest=manifest(FILES)))
+    assert sorted(result['tree']['created']) == sorted(FILES)
+    assert (root / 'dir/sub/c.txt').read_text() == 'c\n'
+    assert (root / m.TREE_INDEX_NAME).exists()
+
+    # Записи индекса моложе самого индекса не доверяются - делаем файлы старше
+    for path in FILES:
+        os.utime(root / path, ns=(10 ** 18, 10 ** 18))
+    result = run_module(dict(tree=str(root), manifest=probe_manifest(FILES)))
+    assert not result['changed']
+
+    # Теперь неизменившиеся файлы подтверждаются только по stat
+    def no_reads(abs_path):
+        raise AssertionError(f'{abs_path} was read')
+    monkeypatch.setattr(m, 'file_checksum', no_reads)
+    result = run_module(dict(tree=str(root), manifest=probe_manifest(FILES)))
+    assert not result['changed']
+    assert result['summary']['unchanged'] == len(FILES)
+
+
+def test_tree_probe_reports_changed_content(tmp_path):
+    root = tmp_path / 'root'
+    run_module(dict(tree=str(root), manifest=manifest(FILES)))
+    (root / 'a.txt').write_text('edited\n')
+
+    result = run_module(dict(tree=str(root), manifest=probe_manifest(FILES)))
+
+    assert result['tree']['content_required'] == ['a.txt']
+    assert (root / 'a.txt').read_text() == 'edited\n'
+
+
+def test_tree_prune(tmp_path):
+    root = tmp_path / 'root'
+    run_module(dict(tree=str(root), manifest=manifest(FILES)))
+    (root / 'dir/sub/extra.txt').write_text('x')
+    (root / 'empty').mkdir()
+    keep = {'a.txt': 'a\n'}
+
+    result = run_module(dict(tree=str(root), manifest=manifest(keep), prune=True), check_mode=True)
+    assert result['tree']['removed'] == ['dir/b.txt', 'dir/sub/c.txt', 'dir/sub/extra.txt']
+    assert (root / 'dir/b.txt').exists()
+
+    result = run_module(dict(tree=str(root), manifest=manifest(keep), prune=True))
+    assert result['tree']['removed'] == ['dir/b.txt', 'dir/sub/c.txt', 'dir/sub/extra.txt']
+    assert not (root / 'dir').exists()
+    # Пустой каталог, в котором ничего не удаляли, и индекс остаются
+    assert (root / 'empty').is_dir()
+    assert (root / m.TREE_INDEX_NAME).exists()
+
+
+@pytest.mark.parametrize('path', ['../outside.txt', '/etc/passwd', '.', 'dir/', m.TREE_INDEX_NAME])
+def test_tree_rejects_paths_outside_files(tmp_path, path):
+    (tmp_path / 'root' / 'dir').mkdir(parents=True)
+    result = run_module(dict(tree=str(tmp_path / 'root'), manifest=[dict(path=path, content='x')]))
+    assert result['failed']
+    assert 'Manifest path' in result['msg']
+
+
+#
+# dedup
+#
+@pytest.fixture
+def store(tmp_path):
+    return m.ContentStore(str(tmp_path / 'store'), m.FileWriter())
+
+
+def test_store_names_objects_by_written_content(store):
+    digest, path = store.add(m.Payload(data=b'payload'), checksum=sha256(b'something else'))
+    assert digest == sha256(b'payload')
+    assert path == store.object_path(digest)
+    with open(path, 'rb') as f:
+        assert f.read() == b'payload'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o444
+
+
+def test_store_reuses_verified_and_rewrites_corrupted_objects(store):
+    digest, path = store.add(m.Payload(data=b'payload'))
+    inode = os.stat(path).st_ino
+    assert store.add(m.Payload(data=b'payload'), checksum=digest) == (digest, path)
+    assert os.stat(path).st_ino == inode
+
+    os.chmod(path, 0o644)
+    with open(path, 'wb') as f:
+        f.write(b'corrupted')
+    assert store.add(m.Payload(data=b'payload'), checksum=digest) == (digest, path)
+    with open(path, 'rb') as f:
+        assert f.read() == b'payload'
+
+
+def test_store_prune_by_last_use(store):
+    _, old = store.add(m.Payload(data=b'old'))
+    _, fresh = store.add(m.Payload(data=b'fresh'))
+    os.utime(old, (time.time() - 10 * 86400,) * 2)
+
+    assert store.prune(5) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+
+
+@pytest.mark.parametrize('reflink', [False, True])
+def test_apply_file_uses_store_only_with_reflink(tmp_path, store, monkeypatch, reflink):
+    monkeypatch.setattr(store, 'can_reflink', lambda abs_path: reflink)
+    path = str(tmp_path / 'file.txt')
+
+    result = m.apply_file(path, m.Payload(data=b'content'), False, store.writer, sha256(b'content'), store=store)
+
+    assert result['created']
+    with open(path, 'rb') as f:
+        assert f.read() == b'content'
+    assert ('dedup' in result) == reflink
+    assert os.path.exists(store.object_path(sha256(b'content'))) == reflink
+
+
+#
+# mode / owner / group
+#
+def test_file_attributes_from_item():
+    defaults = m.FileAttributes.from_item(dict(mode='0640', owner='0', group='root'))
+    assert (defaults.mode, defaults.uid, defaults.gid) == (0o640, 0, 0)
+
+    item = m.FileAttributes.from_item(dict(mode=0o600), defaults)
+    assert (item.mode, item.uid, item.gid) == (0o600, 0, 0)
+
+
+@pytest.mark.parametrize('mode', ['8', 'rw-r--r--', '17777', 0o10000, -1])
+def test_file_attributes_reject_bad_modes(mode):
+    with pytest.raises(ValueError, match='07777'):
+        m.FileAttributes.from_item(dict(mode=mode))
+
+
+def test_bad_mode_fails_the_task(tmp_path):
+    result = run_module(dict(path=str(tmp_path / 'file'), content='x', mode='99999'))
+    assert result['failed']
+    assert '07777' in result['msg']
+
+
+def test_only_attributes_fixed_without_rewrite(tmp_path):
+    path = tmp_path / 'file'
+    path.write_text('content\n')
+    # Без права на чтение - атрибуты все равно исправляются
+    path.chmod(0)
+    inode = path.stat().st_ino
+
+    result = m.apply_file(
+        str(path), m.Payload(data=b'content\n'), False, m.FileWriter(), attrs=m.FileAttributes(mode=0o644),
+    )
+
+    assert result['changed'] and not result['updated']
+    assert result['attributes_changed'] == ['mode']
+    assert stat.S_IMODE(path.stat().st_mode) == 0o644
+    assert path.stat().st_ino == inode
+
+
+def test_attributes_set_on_new_file(tmp_path):
+    path = tmp_path / 'file'
+    m.apply_file(str(path), m.Payload(data=b'x'), False, m.FileWriter(), attrs=m.FileAttributes(mode=0o600))
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='changing the owner needs root')
+def test_owner_set_before_mode_keeps_setgid(tmp_path):
+    path = tmp_path / 'file'
+    path.write_text('x')
+    attrs = m.FileAttributes(mode=0o2755, uid=65534, gid=65534)
+
+    m.FileWriter().set_attributes(str(path), path.stat(), attrs)
+
+    st = path.stat()
+    assert (st.st_uid, st.st_gid, stat.S_IMODE(st.st_mode)) == (65534, 65534, 0o2755)
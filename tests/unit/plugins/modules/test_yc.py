@@ -0,0 +1,392 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import annotations
+
+import threading
+import time
+import types
+
+import pytest
+
+pytest.importorskip('yandexcloud')
+
+import grpc  # noqa: E402
+import yc  # noqa: E402
+from yandex.cloud.compute.v1.disk_pb2 import Disk  # noqa: E402
+from yandex.cloud.compute.v1.disk_service_pb2_grpc import DiskServiceStub  # noqa: E402
+from yandex.cloud.compute.v1.instance_pb2 import (  # noqa: E402
+    AttachedDisk, Instance, NetworkInterface, OneToOneNat, PrimaryAddress,
+)
+from yandex.cloud.operation.operation_pb2 import Operation  # noqa: E402
+from yandex.cloud.operation.operation_service_pb2_grpc import OperationServiceStub  # noqa: E402
+
+GB = 1024 ** 3
+
+
+class StubInstanceService:
+    # Любой вызов записывается и возвращает незавершенную операцию с именем метода
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(request, **kwargs):
+            self.calls.append((name, request))
+            return Operation(id=f'op-{name}')
+        return call
+
+
+class StubDiskService:
+    def __init__(self, disks):
+        self.disks = disks
+
+    def Get(self, request, **kwargs):
+        return self.disks[request.disk_id]
+
+
+class StubSDK:
+    def __init__(self, services=None):
+        self.services = services or {}
+
+    def client(self, stub):
+        return self.services[stub]
+
+
+def new_diff():
+    return {"changes": [], "actions": {action.value: False for action in yc.VMAction}}
+
+
+def instance(status=Instance.Status.RUNNING):
+    return Instance(
+        id='vm-id', name='vm', status=status,
+        network_interfaces=[
+            NetworkInterface(index='0', subnet_id='subnet-a', primary_v4_address=PrimaryAddress(
+                address='10.0.0.5', one_to_one_nat=OneToOneNat(address='1.2.3.4'),
+            )),
+            NetworkInterface(index='1', subnet_id='subnet-b', primary_v4_address=PrimaryAddress(address='10.1.0.5')),
+        ],
+        secondary_disks=[
+            AttachedDisk(device_name='data', disk_id='disk-data'),
+            AttachedDisk(device_name='logs', disk_id='disk-logs'),
+        ],
+    )
+
+
+#
+# NIC и вторичные диски
+#
+def test_desired_nics_defaults():
+    nics = yc.desired_nics(dict(name='vm', network_interfaces=[
+        dict(subnet_id='subnet-a'),
+        dict(index='3', subnet_id='subnet-b', primary_v4_address_spec=dict(nat=False)),
+    ]))
+    assert nics == {'0': dict(subnet_id='subnet-a', nat=True), '3': dict(subnet_id='subnet-b', nat=False)}
+    assert yc.desired_nics(dict(name='vm')) is None
+    assert yc.desired_nics(dict(name='vm', network_interface_specs=dict(subnet_id='s'))) == {
+        '0': dict(subnet_id='s', nat=True),
+    }
+
+
+def test_desired_devices_validation():
+    with pytest.raises(yc.YCModuleError, match='mutually exclusive'):
+        yc.desired_nics(dict(name='vm', network_interfaces=[], network_interface_specs=dict(subnet_id='s')))
+    with pytest.raises(yc.YCModuleError, match='needs disk_id or disk_spec.size'):
+        yc.desired_disks(dict(name='vm', secondary_disk_specs=[dict(device_name='data', disk_spec={})]))
+    assert yc.desired_disks(dict(name='vm')) is None
+
+
+def test_diff_devices_nic_ops():
+    diff = new_diff()
+    vm = dict(name='vm', network_interfaces=[
+        # NAT снят, подсеть та же
+        dict(index='0', subnet_id='subnet-a', primary_v4_address_spec=dict(nat=False)),
+        # NIC 1 отключается, NIC 2 добавляется
+        dict(index='2', subnet_id='subnet-c'),
+    ])
+
+    yc.diff_devices(vm, StubSDK(), instance(), diff)
+
+    assert diff["nic_ops"] == [
+        ("detach_nic", "1"),
+        ("remove_nat", "0", "10.0.0.5"),
+        ("attach_nic", "2", dict(subnet_id='subnet-c', nat=True)),
+    ]
+    assert diff["actions"][yc.VMAction.RESTART.value]
+    assert yc.needs_stop(diff)
+
+
+def test_diff_devices_subnet_change_sets_nat_itself():
+    diff = new_diff()
+    vm = dict(name='vm', network_interfaces=[
+        dict(index='0', subnet_id='subnet-new', primary_v4_address_spec=dict(nat=False)),
+        dict(index='1', subnet_id='subnet-b', primary_v4_address_spec=dict(nat=False)),
+    ])
+
+    yc.diff_devices(vm, StubSDK(), instance(), diff)
+
+    assert diff["nic_ops"] == [("update_nic", "0", dict(subnet_id='subnet-new', nat=False))]
+    assert "network_interfaces[0].nat: True -> False" in diff["changes"]
+
+
+def test_diff_devices_disk_ops():
+    disks = {
+        'disk-data': Disk(id='disk-data', size=10 * GB, type_id='network-hdd'),
+        'disk-logs': Disk(id='disk-logs', size=10 * GB, type_id='network-hdd'),
+    }
+    sdk = StubSDK({DiskServiceStub: StubDiskService(disks)})
+    diff = new_diff()
+    vm = dict(name='vm', secondary_disk_specs=[
+        dict(device_name='data', disk_spec=dict(size=20)),
+        dict(device_name='cache', disk_spec=dict(size=5)),
+    ])
+
+    yc.diff_devices(vm, sdk, instance(), diff)
+
+    assert diff["disk_ops"] == [
+        ("detach", "logs"),
+        ("resize", "disk-data", 20),
+        ("attach", dict(device_name='cache', disk_spec=dict(size=5))),
+    ]
+    assert diff["actions"][yc.VMAction.INPLACE.value]
+    assert not diff["actions"][yc.VMAction.RECREATE.value]
+    assert not yc.needs_stop(diff)
+
+
+@pytest.mark.parametrize('spec', [dict(size=5), dict(size=10, type_id='network-ssd')])
+def test_diff_devices_disk_shrink_or_type_change_needs_recreate(spec):
+    sdk = StubSDK({DiskServiceStub: StubDiskService({
+        'disk-data': Disk(id='disk-data', size=10 * GB, type_id='network-hdd'),
+    })})
+    diff = new_diff()
+    vm = dict(name='vm', secondary_disk_specs=[dict(device_name='data', disk_spec=spec), dict(device_name='logs', disk_id='disk-logs')])
+
+    yc.diff_devices(vm, sdk, instance(), diff)
+
+    assert diff["actions"][yc.VMAction.RECREATE.value]
+
+
+#
+# Stop/Start вокруг изменений, которым нужна остановленная VM
+#
+@pytest.fixture
+def operations(monkeypatch):
+    started = []
+
+    def run_operation(sdk, deadline, action, start, meta_type=None):
+        name = start().id[len('op-'):]
+        started.append(name)
+        if name == 'Update' and 'fail' in started:
+            raise RuntimeError('update failed')
+
+    monkeypatch.setattr(yc, 'run_operation', run_operation)
+    return started
+
+
+@pytest.mark.parametrize('status, start, expected', [
+    (Instance.Status.RUNNING, False, ['Stop', 'Update', 'Start']),
+    (Instance.Status.STOPPED, False, ['Update']),
+    (Instance.Status.STOPPED, True, ['Update', 'Start']),
+])
+def test_update_instance_stop_window(operations, status, start, expected):
+    diff = dict(changes=["resources_spec.cores: 2 -> 4"], start=start)
+    error = yc.update_instance(
+        None, StubInstanceService(), dict(resources_spec=dict(cores=4)), instance(status), diff, yc.Deadline(),
+    )
+    assert error is None
+    assert operations == expected
+
+
+@pytest.mark.parametrize('status, expected', [
+    (Instance.Status.RUNNING, ['fail', 'Stop', 'Update', 'Start']),
+    # Остановленную пользователем VM ошибка не запускает
+    (Instance.Status.STOPPED, ['fail', 'Update']),
+])
+def test_update_instance_error_restores_only_own_stop(operations, status, expected):
+    operations.append('fail')
+    diff = dict(changes=["resources_spec.cores: 2 -> 4"], start=False)
+    error = yc.update_instance(
+        None, StubInstanceService(), dict(resources_spec=dict(cores=4)), instance(status), diff, yc.Deadline(),
+    )
+    assert str(error) == 'update failed'
+    assert operations == expected
+
+
+#
+# Бюджет времени и таймауты операций
+#
+class DeadlineExceeded(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.DEADLINE_EXCEEDED
+
+    def details(self):
+        return 'deadline exceeded'
+
+
+class StubOperationService:
+    # done_after - номер Get, на котором операция завершается; hang - Get висит до своего deadline
+    def __init__(self, done_after=None, hang=False, error=None):
+        self.done_after = done_after
+        self.hang = hang
+        self.error = error
+        self.polls = []
+        self.cancelled = []
+
+    def Get(self, request, timeout=None):
+        self.polls.append(timeout)
+        if self.hang:
+            time.sleep(timeout)
+            raise DeadlineExceeded()
+        done = self.done_after is not None and len(self.polls) >= self.done_after
+        operation = Operation(id=request.operation_id, done=done)
+        if done and self.error:
+            operation.error.code = 13
+            operation.error.message = self.error
+        return operation
+
+    def Cancel(self, request):
+        self.cancelled.append(request.operation_id)
+
+
+def operation_sdk(operation_service):
+    return StubSDK({OperationServiceStub: operation_service})
+
+
+def test_deadline_operation_timeout():
+    assert yc.Deadline().operation_timeout('update') is None
+    assert not yc.Deadline().expired()
+    deadline = yc.Deadline(100, dict(update=5, stop=None))
+    assert deadline.operation_timeout('update') == 5
+    assert 99 < deadline.operation_timeout('stop') <= 100
+
+
+def test_run_operation_waits_for_completion():
+    service = StubOperationService(done_after=1)
+    result = yc.run_operation(operation_sdk(service), yc.Deadline(30), 'update', lambda: Operation(id='op1'))
+    assert result.done
+    assert service.cancelled == []
+    assert all(0 < timeout <= 30 for timeout in service.polls)
+
+
+def test_run_operation_failed_operation():
+    service = StubOperationService(done_after=1, error='quota exceeded')
+    with pytest.raises(RuntimeError, match='quota exceeded'):
+        yc.run_operation(operation_sdk(service), yc.Deadline(30), 'update', lambda: Operation(id='op1'))
+
+
+@pytest.mark.parametrize('hang', [False, True])
+def test_run_operation_timeout_cancels(hang):
+    service = StubOperationService(hang=hang)
+    deadline = yc.Deadline(30, dict(update=1.5))
+    start = time.monotonic()
+
+    with pytest.raises(yc.OperationTimeout) as error:
+        yc.run_operation(operation_sdk(service), deadline, 'update', lambda: Operation(id='op1'))
+
+    # Зависший Get не держит задачу дольше таймаута операции
+    assert time.monotonic() - start < 2.5
+    assert service.cancelled == ['op1']
+    assert yc.error_status(error.value) == 'timeout'
+
+
+def test_run_operation_not_started_after_budget():
+    deadline = yc.Deadline(1)
+    deadline.deadline = time.monotonic() - 1
+    started = []
+    with pytest.raises(yc.OperationNotStarted) as error:
+        yc.run_operation(StubSDK(), deadline, 'update', lambda: started.append(1))
+    assert started == []
+    assert yc.error_status(error.value) == 'interrupted'
+    assert yc.error_status(RuntimeError()) == 'error'
+
+
+def test_folder_scan_out_of_budget_reports_not_started():
+    class SlowInstanceService:
+        def List(self, request, timeout=None):
+            raise DeadlineExceeded()
+
+    plans = yc.plan_folder(None, SlowInstanceService(), 'folder', [(0, dict(name='a')), (1, dict(name='b'))],
+                           yc.Deadline(30))
+    results = yc.apply_folder(None, SlowInstanceService(), False, 'folder', plans, yc.Deadline(30))
+
+    assert [result['status'] for _, result in results] == ['not_started', 'not_started']
+    assert yc.progress_report([result for _, result in results]) == dict(
+        completed=[], in_progress=[], interrupted=[], not_started=['a', 'b'],
+    )
+
+
+def test_folder_scan_error_without_budget_fails():
+    class BrokenInstanceService:
+        def List(self, request, timeout=None):
+            raise DeadlineExceeded()
+
+    with pytest.raises(yc.YCModuleError, match='scan failed'):
+        yc.plan_folder(None, BrokenInstanceService(), 'folder', [(0, dict(name='a'))], yc.Deadline())
+
+
+#
+# worker
+#
+def module_params(**params):
+    spec = yc.build_arguments(yc.FIELDS_SPEC)
+    defaults = {name: option.get("default") for name, option in spec.items()}
+    defaults.update(params)
+    return defaults
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    # Worker в потоке теста; reconcile и SDK подменены, запросы к облаку не уходят
+    built = []
+    monkeypatch.setattr(yc, 'build_sdk', lambda params: built.append(params['token']) or object())
+
+    def reconcile(sdk, params, check_mode, folder_cache=None):
+        time.sleep(params.get('test_delay') or 0)
+        if params.get('test_error'):
+            raise yc.YCModuleError(params['test_error'], diff=dict(name='vm'))
+        return dict(instances=[dict(name='vm', check_mode=check_mode)], timed_out=False)
+
+    monkeypatch.setattr(yc, 'reconcile', reconcile)
+    directory = tmp_path / 'sock'
+    yc.private_dir(str(directory))
+    socket_path = str(directory / 'worker.sock')
+    server = yc.YCWorker(socket_path, idle_timeout=1)
+    thread = threading.Thread(target=server.serve_until_idle)
+    thread.start()
+    yield types.SimpleNamespace(socket=socket_path, built=built, thread=thread)
+    thread.join(10)
+    server.server_close()
+
+
+def test_worker_round_trip_and_sdk_cache(worker):
+    params = module_params(token='t1', worker_socket=worker.socket)
+    assert yc.call_worker(params, True) == dict(instances=[dict(name='vm', check_mode=True)], timed_out=False)
+    yc.call_worker(params, False)
+    yc.call_worker(module_params(token='t2', worker_socket=worker.socket), False)
+    # Один SDK на набор учетных данных
+    assert worker.built == ['t1', 't2']
+
+
+def test_worker_reports_module_errors(worker):
+    response = yc.call_worker(module_params(token='t', worker_socket=worker.socket, test_error='boom'), False)
+    assert response == dict(failed=True, msg='boom', diff=dict(name='vm'))
+
+
+def test_worker_does_not_exit_during_a_request(worker):
+    # Запрос длиннее idle_timeout: worker ждет его окончания, а не выходит по простою
+    params = module_params(token='t', worker_socket=worker.socket, test_delay=2)
+    assert yc.call_worker(params, False)['instances'][0]['name'] == 'vm'
+    worker.thread.join(5)
+    assert not worker.thread.is_alive()
+
+
+def test_private_dir_rejects_open_directories(tmp_path):
+    directory = tmp_path / 'open'
+    directory.mkdir(mode=0o755)
+    directory.chmod(0o755)
+    with pytest.raises(PermissionError, match='0700'):
+        yc.private_dir(str(directory))
+
+
+def test_default_socket_is_keyed_by_module_code(monkeypatch, tmp_path):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmp_path))
+    path = yc.default_worker_socket()
+    assert path == str(tmp_path / 'yc-worker' / f'yc-worker-{yc.module_fingerprint()}.sock')
+    assert len(yc.module_fingerprint()) == 12